@@ -0,0 +1,87 @@
+"""Measures how many votes per second can be taken in when each vote is cast and committed on its own, which is what
+/home/post/<id>/refresh does, against buffering them in the vote buffer and writing them with bulk upserts.
+
+Run it from the app directory, e.g. `python bench_votes.py --votes 20000`. It works on a database of its own, a
+temporary sqlite file unless --database is given; never point it at the database of the app, its tables are dropped.
+"""
+from datetime import datetime
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from flask import Flask
+
+from buffer import WriteBuffer
+from models import db, Post, User, Vote, VOTE_TIME_FORMAT
+
+
+def setup(users, choices):
+    """creates the voters and the popular post they vote on; returns the post id and its choice ids"""
+    db.drop_all()
+    db.create_all()
+    db.session.execute(User.__table__.insert(),
+                       [{'user_id': user_id, 'email': 'voter%d@example.com' % user_id, 'password_hash': '',
+                         'user_name': 'voter %d' % user_id, 'age_range': 21, 'gender': 'female',
+                         'profile_pic': ''} for user_id in range(1, users + 1)])
+    db.session.commit()
+    post = Post.create(author_id=1, description="the popular post", file_name=None, tag_list=None,
+                       choice_data=[("choice %d" % number, None) for number in range(choices)])
+    return post.post_id, [choice.choice_id for choice in post.choices]
+
+
+def cast_each(votes, **options):
+    for user_id, post_id, choice_id in votes:
+        Vote.cast(user_id, post_id, choice_id)
+
+
+def cast_buffered(votes, log_path=None, fsync=False, size=500):
+    vote_buffer = WriteBuffer(Vote.cast_many, max_size=size, log_path=log_path, fsync=fsync)
+    vote_buffer.start()
+    for user_id, post_id, choice_id in votes:
+        vote = [user_id, post_id, choice_id, datetime.utcnow().strftime(VOTE_TIME_FORMAT)]
+        if vote_buffer.add((user_id, post_id), vote):
+            vote_buffer.flush()
+    vote_buffer.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Vote ingestion benchmark")
+    parser.add_argument('--votes', type=int, default=5000, help="the number of votes cast in each run")
+    parser.add_argument('--users', type=int, default=2000, help="the number of voters; fewer voters, more repeats")
+    parser.add_argument('--choices', type=int, default=2)
+    parser.add_argument('--buffer-size', type=int, default=500, help="the votes the buffer flushes at once")
+    parser.add_argument('--database', help="a database url, a temporary sqlite database by default")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database or 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    db.app = app
+    db.init_app(app)
+
+    runs = [("one commit per vote", cast_each, {}),
+            ("buffered, in memory", cast_buffered, {'size': args.buffer_size}),
+            ("buffered, logged", cast_buffered, {'size': args.buffer_size,
+                                                 'log_path': os.path.join(workdir, 'votes.log')}),
+            ("buffered, logged with fsync", cast_buffered, {'size': args.buffer_size, 'fsync': True,
+                                                            'log_path': os.path.join(workdir, 'votes.log')})]
+    try:
+        with app.app_context():
+            for name, run, options in runs:
+                post_id, choice_ids = setup(args.users, args.choices)
+                random.seed(0)
+                votes = [(random.randint(1, args.users), post_id, random.choice(choice_ids))
+                         for _ in range(args.votes)]
+                started = time.time()
+                run(votes, **options)
+                elapsed = time.time() - started
+                stored = Vote.query.count()
+                print "%-30s %10.0f votes/s  (%d votes stored)" % (name, args.votes / elapsed, stored)
+    finally:
+        shutil.rmtree(workdir)
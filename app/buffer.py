@@ -0,0 +1,241 @@
+"""Write-behind buffering of the writes that come in bursts, e.g. the votes on a post that was just shared."""
+
+from collections import OrderedDict
+import errno
+import json
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def process_log_path(base_path):
+    """the log of this process, for the servers of several processes: base_path suffixed with the pid"""
+    return '%s.%d' % (base_path, os.getpid())
+
+
+def orphaned_logs(base_path):
+    """the logs at base_path and at the process_log_path() of the processes no longer running, to be adopted by a
+    buffer of a running one"""
+    pattern = re.compile(re.escape(os.path.basename(base_path)) + r'\.(\d+)(\.flushing|\.adopted\d+)?$')
+    pids = set()
+    for name in os.listdir(os.path.dirname(base_path) or '.'):
+        match = pattern.match(name)
+        if match:
+            pids.add(int(match.group(1)))
+    return [base_path] + ['%s.%d' % (base_path, pid) for pid in sorted(pids)
+                          if pid != os.getpid() and not _running(pid)]
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM  # someone else's
+    return True
+
+
+class WriteBuffer(object):
+    """Collects writes in memory and hands them to write(values) in bulk, instead of writing each on its own.
+
+    Writes are keyed by what they overwrite, so a write replaces the one for the same key still waiting, and only the
+    last of them is written. add() returns True once max_size writes are waiting, for the caller to have them flushed;
+    flush() is also called every few seconds by a Flusher. Until start() is called add() writes through at once.
+
+    With a log_path every write is appended to that file before add() returns, and the file is replayed by start(),
+    so the writes waiting when the process died are not lost; with fsync they even survive a crash of the machine, at
+    the cost of a disk sync per write. Keys and values must be json serializable; keys come back from the log as
+    tuples.
+
+    When writing a batch fails, it is written again in halves, down to single writes, so a write that can't be done
+    (e.g. a vote on a choice deleted meanwhile) doesn't hold back the others. A write failing on its own is retried
+    with the next flushes, and after max_attempts it is given up: logged as an error, and appended to
+    dead_letter_path if there is one. The errors of the transient classes (e.g. the database being down) fail no
+    write in particular: the flush stops there, and everything not written is kept for the next one."""
+
+    def __init__(self, write, max_size=500, log_path=None, fsync=False, max_attempts=3, dead_letter_path=None,
+                 transient=()):
+        self.write = write
+        self.max_size = max_size
+        self.log_path = log_path
+        self.fsync = fsync
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path
+        self.transient = transient
+        self.started = False
+        self._pending = OrderedDict()
+        self._attempts = {}  # key -> the flushes its write failed in on its own
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time, so the log being flushed is never overwritten
+        self._log = None
+
+    def start(self, adopt=()):
+        """replays the writes left in the log by the previous run, and those in the logs at adopt, left by other
+        processes that are gone, then starts buffering"""
+        if self.log_path:
+            self._pending = self._replay(self._claim(adopt))
+            self._log = open(self.log_path, 'a')
+        self.started = True
+
+    def add(self, key, value):
+        if not self.started:
+            self.write([value])
+            return False
+        with self._lock:
+            self._pending.pop(key, None)  # the latest write goes last
+            self._pending[key] = value
+            self._attempts.pop(key, None)
+            if self._log is not None:
+                self._append(self._log, [(key, value)])
+            return len(self._pending) >= self.max_size
+
+    def pending(self, key):
+        """the value waiting to be written for key, None if there is none"""
+        with self._lock:
+            return self._pending.get(key)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """writes everything waiting; returns the number of writes done. The writes that fail are kept for the next
+        flush, or given up after max_attempts"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+                if not batch:
+                    return 0
+                if self._log is not None:  # the writes coming in meanwhile go to a new log
+                    self._log.close()
+                    os.rename(self.log_path, self._flushing_path)
+                    self._log = open(self.log_path, 'a')
+
+            try:
+                written, failed = self._write_all(batch.items())
+            except Exception:  # a transient error
+                self._keep(batch)
+                raise
+            finally:
+                if self.log_path and os.path.exists(self._flushing_path):
+                    os.remove(self._flushing_path)
+
+            retried, given_up = OrderedDict(), []
+            with self._lock:
+                for key in batch:
+                    if key not in failed:
+                        self._attempts.pop(key, None)
+                for key, value in failed.items():
+                    self._attempts[key] = self._attempts.get(key, 0) + 1
+                    if self._attempts[key] < self.max_attempts:
+                        retried[key] = value
+                    else:
+                        del self._attempts[key]
+                        given_up.append((key, value))
+            if retried:
+                self._keep(retried)
+            if given_up:
+                self._give_up(given_up)
+            return written
+
+    def _write_all(self, items):
+        """writes the items, in halves if that fails, and so on down to single writes; returns the number of writes
+        done and an OrderedDict of the writes that failed on their own"""
+        try:
+            self.write([value for key, value in items])
+            return len(items), OrderedDict()
+        except self.transient:
+            raise
+        except Exception:
+            if len(items) == 1:
+                log.warning("the buffered write of %r failed", items[0][0], exc_info=True)
+                return 0, OrderedDict(items)
+            log.warning("writing %d buffered writes failed, writing them in halves", len(items))
+        middle = len(items) // 2
+        written, failed = self._write_all(items[:middle])
+        more_written, more_failed = self._write_all(items[middle:])
+        failed.update(more_failed)
+        return written + more_written, failed
+
+    def _keep(self, batch):
+        """puts the writes of batch back for the next flush, behind the writes added since, which supersede them"""
+        with self._lock:
+            for key, value in self._pending.items():
+                batch.pop(key, None)
+                batch[key] = value
+            self._pending = batch
+            if self._log is not None:
+                self._log.close()
+                self._rewrite_log(batch)
+                self._log = open(self.log_path, 'a')
+
+    def _give_up(self, entries):
+        for key, value in entries:
+            log.error("gave up the buffered write of %r after %d attempts: %r", key, self.max_attempts, value)
+        if self.dead_letter_path:
+            with open(self.dead_letter_path, 'a') as fp:
+                self._append(fp, entries)
+
+    @property
+    def _flushing_path(self):
+        return self.log_path + '.flushing'
+
+    def _append(self, fp, entries):
+        for key, value in entries:
+            fp.write(json.dumps([key, value]) + '\n')
+        fp.flush()
+        if self.fsync:
+            os.fsync(fp.fileno())
+
+    def _claim(self, paths):
+        """moves the logs at paths aside, along with what was being flushed or adopted from them, for this buffer to
+        replay; returns the paths they were moved to, oldest first. The logs claimed by another process first, or
+        not there, are left out"""
+        claimed = []
+        for path in paths:
+            if path == self.log_path:
+                continue
+            directory, prefix = os.path.dirname(path) or '.', os.path.basename(path) + '.adopted'
+            adopted = sorted((int(name[len(prefix):]), os.path.join(directory, name)) for name in os.listdir(directory)
+                             if name.startswith(prefix) and name[len(prefix):].isdigit())
+            for source in [name for number, name in adopted] + [path + '.flushing', path]:
+                target = '%s.adopted%d' % (self.log_path, len(claimed))
+                try:
+                    os.rename(source, target)
+                except OSError:
+                    continue
+                claimed.append(target)
+        return claimed
+
+    def _replay(self, adopted=()):
+        """the writes in the adopted logs, the log being flushed and the log, in that order, consolidated into a new
+        log"""
+        pending = OrderedDict()
+        for path in list(adopted) + [self._flushing_path, self.log_path]:
+            if not os.path.exists(path):
+                continue
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:  # the line being written when the process died
+                        log.warning("skipped a truncated entry of %s", path)
+                        continue
+                    key = tuple(key) if isinstance(key, list) else key
+                    pending.pop(key, None)
+                    pending[key] = value
+        self._rewrite_log(pending)
+        for path in [self._flushing_path] + list(adopted):
+            if os.path.exists(path):
+                os.remove(path)
+        if pending:
+            log.info("replayed %d writes from %s", len(pending), self.log_path)
+        return pending
+
+    def _rewrite_log(self, entries):
+        replacement = self.log_path + '.new'
+        with open(replacement, 'w') as fp:
+            self._append(fp, entries.items())
+            os.fsync(fp.fileno())
+        os.rename(replacement, self.log_path)
@@ -0,0 +1,138 @@
+"""In-process caches shared by the models."""
+
+from collections import OrderedDict
+import bisect
+import copy
+import threading
+import time
+
+
+class VersionedCache(object):
+    """A bounded, thread safe cache where every value is stored together with the version of the row it was built
+    from; a lookup only hits when the caller asks for that same version, so bumping the version of a row in the
+    database is enough to invalidate the value in every process. The least recently used entries are dropped once
+    there are more than max_entries."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (version, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """returns the value cached for this version of the key, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            if entry[0] != version:
+                return None
+            return entry[1]
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def update(self, key, from_version, to_version, function):
+        """moves the value cached for from_version to to_version by applying function to a copy of it, so a write
+        can patch the cached value instead of having it recomputed; if the cache doesn't hold from_version the entry
+        is dropped instead. Returns True when the value was updated"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != from_version:
+                return False
+            self._entries[key] = (to_version, function(copy.deepcopy(entry[1])))
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TimedCache(object):
+    """A thread safe cache for values that may be served somewhat stale: an entry is good for ttl seconds after it
+    was set, a ttl of 0 disables the cache. Used for the aggregates that are too costly to build on every request but
+    don't have a version to key them on."""
+
+    def __init__(self, ttl=60, clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = {}  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """returns the value cached for the key if it hasn't expired yet, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class PrefixIndex(object):
+    """A thread safe, case insensitive prefix index over a set of names, each with a score to rank the matches by.
+    The names are kept in a sorted list, so a lookup is a bisect to the first match followed by a scan over the
+    matches only, and adding a name is an insort. The index goes stale ttl seconds after it was loaded, None keeps
+    it forever."""
+
+    def __init__(self, ttl=None, clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._keys = []  # sorted (lowercased name, name) pairs
+        self._scores = {}  # name -> score
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self):
+        """True until the index is loaded, and again once it is older than the ttl"""
+        loaded_at = self._loaded_at
+        if loaded_at is None:
+            return True
+        return self.ttl is not None and self._clock() - loaded_at >= self.ttl
+
+    def load(self, items):
+        """replaces the content of the index with the (name, score) pairs in items"""
+        scores = dict(items)
+        keys = sorted((name.lower(), name) for name in scores)
+        with self._lock:
+            self._keys, self._scores = keys, scores
+            self._loaded_at = self._clock()
+
+    def add(self, name, score=0):
+        with self._lock:
+            if name not in self._scores:
+                bisect.insort(self._keys, (name.lower(), name))
+            self._scores[name] = score
+
+    def search(self, prefix, limit=10):
+        """returns up to limit names starting with prefix, the best scored first"""
+        prefix = prefix.lower()
+        matches = []
+        with self._lock:
+            keys = self._keys
+            for position in xrange(bisect.bisect_left(keys, (prefix,)), len(keys)):
+                key, name = keys[position]
+                if not key.startswith(prefix):
+                    break
+                matches.append((-self._scores[name], key, name))
+        return [name for _, _, name in sorted(matches)[:limit]]
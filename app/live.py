@@ -0,0 +1,160 @@
+"""Pushing the results of posts to the pages showing them as they change, as server-sent events."""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    """What one open page listens to: only the latest update is kept, an update not yet sent when the next one comes
+    is simply replaced by it, so a slow client never queues up updates."""
+
+    def __init__(self, key, version=None):
+        self.key = key
+        self.version = version  # the version the client shows
+        self._latest = None
+        self._ready = threading.Event()
+
+    def offer(self, version, data):
+        if version == self.version:
+            return
+        self._latest = (version, data)
+        self._ready.set()
+
+    def next(self, timeout):
+        """waits up to timeout seconds for an update; returns (version, data), or None on a timeout"""
+        if not self._ready.wait(timeout):
+            return None
+        self._ready.clear()
+        latest, self._latest = self._latest, None
+        if latest is None or latest[0] == self.version:
+            return None
+        self.version = latest[0]
+        return latest
+
+
+class ResultsHub(object):
+    """One thread watching the versions of the rows pages are subscribed to, and publishing the new data of a row to
+    all its subscribers when its version changes.
+
+    versions(keys) returns a dict of key -> version for the keys still there, read in one go; render(key) returns the
+    data for the current version of key, as a string. The data is rendered once per version whatever the number of
+    subscribers, and a row is published at most rate times a second however fast it changes, the changes in between
+    are coalesced. Watching versions in the database, the hub also sees the changes made by other processes; notify()
+    only has it look again sooner. The thread is started, within the context of the flask app given, by the first
+    subscribe() and waits on nothing but its timer and notify(), so idle subscriptions cost no more than their
+    Subscription: with gevent workers thousands of them are served by one process."""
+
+    def __init__(self, versions, render, rate=2):
+        self.versions = versions
+        self.render = render
+        self.rate = rate
+        self._subscriptions = {}  # key -> set of Subscription
+        self._published = {}  # key -> (version, data, time published)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._app = None
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self, app=None):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            self._thread = threading.Thread(target=self._work, name='results-hub')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def subscribe(self, key, version=None, app=None):
+        """subscribes to the updates of key, for a client showing version of it; the latest data published is
+        offered at once if the client shows an older version"""
+        subscription = Subscription(key, version)
+        with self._lock:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+            published = self._published.get(key)
+        if published is not None:
+            subscription.offer(published[0], published[1])
+        if not self.started:
+            self.start(app)
+        self.notify()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.key)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.key]
+                self._published.pop(subscription.key, None)
+
+    def subscribers(self, key):
+        with self._lock:
+            return len(self._subscriptions.get(key, ()))
+
+    def notify(self):
+        self._wake.set()
+
+    def poll(self, now=None):
+        """publishes the data of the watched rows whose version changed since they were last published, unless they
+        were published less than 1 / rate seconds ago; returns the keys published"""
+        now = time.time() if now is None else now
+        with self._lock:
+            keys = list(self._subscriptions)
+        if not keys:
+            return []
+
+        published = []
+        for key, version in self.versions(keys).items():
+            with self._lock:
+                last = self._published.get(key)
+            if last is not None and (last[0] == version or now - last[2] < 1.0 / self.rate):
+                continue
+            data = self.render(key)
+            with self._lock:
+                if key not in self._subscriptions:  # everyone left meanwhile
+                    continue
+                self._published[key] = (version, data, now)
+                subscriptions = list(self._subscriptions[key])
+            for subscription in subscriptions:
+                subscription.offer(version, data)
+            published.append(key)
+        return published
+
+    def _work(self):
+        while True:
+            self._wake.wait(1.0 / self.rate)
+            self._wake.clear()
+            try:
+                if self._app is not None:
+                    with self._app.app_context():
+                        self.poll()
+                else:
+                    self.poll()
+            except Exception:
+                log.exception("polling the results failed, it will be retried")
+
+
+def event_stream(hub, subscription, heartbeat=15, retry=3000):
+    """the server-sent events of a subscription: one 'results' event per update, with the version as its id, and a
+    comment every heartbeat seconds, which keeps proxies from closing the connection and lets the server notice when
+    the client is gone. The subscription is dropped once the stream is closed"""
+    try:
+        yield "retry: %d\n\n" % retry
+        while True:
+            update = subscription.next(heartbeat)
+            if update is None:
+                yield ": heartbeat\n\n"
+                continue
+            version, data = update
+            yield "id: %s\nevent: results\n%s\n\n" % (version, "\n".join("data: " + line
+                                                                           for line in data.split("\n")))
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,95 @@
+"""Maintenance commands for the Opinionated database.
+
+Run them from the app directory, e.g. `python manage.py reconcile-votes`
+"""
+import argparse
+
+from models import Choice, PendingDeletion, Post, Tag, TimelineEntry, Vote, backfill_variants, connect_to_db, \
+    install_search, install_triggers
+
+
+def reconcile_votes(args):
+    """rebuild the vote counts of the choices from the votes table"""
+    if args.install_triggers:
+        install_triggers()
+    deleted = Vote.reconcile_post_ids()
+    print "Deleted %d duplicate votes" % deleted
+    updated = Choice.reconcile_vote_counts(post_id=args.post_id)
+    print "Rebuilt the vote counts of %d choices" % updated
+
+
+def rebuild_timelines(args):
+    """rebuild the followed feeds of all users from the follows and the posts"""
+    TimelineEntry.rebuild()
+    print "Rebuilt the timelines"
+
+
+def reconcile_tags(args):
+    """rebuild the post counts of the tags from the tagsposts table"""
+    updated = Tag.reconcile_post_counts()
+    print "Rebuilt the post counts of %d tags" % updated
+
+
+def reconcile_comments(args):
+    """rebuild the comment counts of the posts from the comments table"""
+    updated = Post.reconcile_comment_counts()
+    print "Rebuilt the comment counts of %d posts" % updated
+
+
+def rebuild_search(args):
+    """create the search index if needed and index all the posts again"""
+    install_search()
+    indexed = Post.rebuild_search_index()
+    print "Indexed %d posts" % indexed
+
+
+def flush_deletions(args):
+    """delete the objects of deleted posts still waiting to be deleted from s3"""
+    deleted = PendingDeletion.flush()
+    print "Deleted %d objects, %d left" % (deleted, PendingDeletion.query.count())
+
+
+def backfill_image_variants(args):
+    """store the thumbnail and medium variants of the images uploaded before they existed"""
+    done = backfill_variants()
+    print "Stored the variants of %d images" % done
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Maintenance commands for Opinionated")
+    commands = parser.add_subparsers()
+
+    reconcile = commands.add_parser('reconcile-votes', help=reconcile_votes.__doc__)
+    reconcile.add_argument('--post-id', type=int, help="only rebuild the counts of this post")
+    reconcile.add_argument('--install-triggers', action='store_true',
+                           help="also (re)create the triggers that keep the counts up to date")
+    reconcile.set_defaults(func=reconcile_votes)
+
+    timelines = commands.add_parser('rebuild-timelines', help=rebuild_timelines.__doc__)
+    timelines.set_defaults(func=rebuild_timelines)
+
+    tags = commands.add_parser('reconcile-tags', help=reconcile_tags.__doc__)
+    tags.set_defaults(func=reconcile_tags)
+
+    comments = commands.add_parser('reconcile-comments', help=reconcile_comments.__doc__)
+    comments.set_defaults(func=reconcile_comments)
+
+    search = commands.add_parser('rebuild-search', help=rebuild_search.__doc__)
+    search.set_defaults(func=rebuild_search)
+
+    deletions = commands.add_parser('flush-deletions', help=flush_deletions.__doc__)
+    deletions.set_defaults(func=flush_deletions)
+
+    variants = commands.add_parser('backfill-variants', help=backfill_image_variants.__doc__)
+    variants.set_defaults(func=backfill_image_variants)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    from server import app
+    connect_to_db(app)
+
+    args.func(args)
@@ -1,15 +1,30 @@
 """Models and database functions for Opinionated project."""
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, Pagination
+from sqlalchemy import event, DDL
+from sqlalchemy.exc import OperationalError
 from flask import flash
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+from collections import Counter, OrderedDict, namedtuple
+from functools import wraps
+import atexit
+import copy
+import json
 import os
-import hashlib
+import base64
+import threading
+import mimetypes
+import uuid
 import psycopg2, urlparse
 
+from buffer import WriteBuffer, process_log_path, orphaned_logs
+from cache import VersionedCache, TimedCache, PrefixIndex
+from live import ResultsHub
+from search import TermIndex, DocumentIndex
+from storage import connect_s3, upload_form, content_md5, variant_key, UploadPool, InvalidUpload, UploadTooLarge, \
+    Flusher
+
 
 # This is the connection to the SQLite database; we're getting this through
 # the Flask-SQLAlchemy helper library. On this, we can find the `session`
@@ -17,13 +32,122 @@ import psycopg2, urlparse
 
 db = SQLAlchemy()
 
+
+class UnitOfWork(object):
+    """An opt-in unit of work. Within one the model helpers only flush their changes, and they are committed together
+    when the outermost unit of work ends, or all rolled back if it raises, so a request doing several steps commits
+    once and never leaves half of them behind. Used as a context manager or as a decorator, e.g. of a view:
+
+        @app.route(...)
+        @UnitOfWork()
+        def view():
+            ...
+
+    Nested units of work join the one they are in. The state is per thread, like the session."""
+
+    _state = threading.local()
+
+    @classmethod
+    def active(cls):
+        return getattr(cls._state, 'depth', 0) > 0
+
+    @classmethod
+    def after_commit(cls, callback):
+        """calls callback once the changes made so far are committed: at once outside a unit of work, at the end of
+        the outermost one within one; dropped if it rolls back"""
+        if cls.active():
+            cls._state.callbacks.append(callback)
+        else:
+            callback()
+
+    def __enter__(self):
+        state = self._state
+        state.depth = getattr(state, 'depth', 0) + 1
+        if state.depth == 1:
+            state.callbacks = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state = self._state
+        state.depth -= 1
+        if state.depth:
+            return False
+        callbacks, state.callbacks = state.callbacks, []
+        if exc_type is not None:
+            db.session.rollback()
+            return False
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for callback in callbacks:
+            callback()
+        return False
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with UnitOfWork():
+                return f(*args, **kwargs)
+        return decorated_function
+
+
+def commit():
+    """commits the session, or only flushes it within a unit of work, which commits at its end"""
+    if UnitOfWork.active():
+        db.session.flush()
+    else:
+        db.session.commit()
+
 # setup for s3
-conn = S3Connection(os.environ["AWS_ACCESS_KEY"], os.environ["AWS_SECRET_KEY"])
+conn = connect_s3()
 bucket = conn.get_bucket(os.environ['AWS_BUCKET'])
+# where the images are served from
+S3_URL = os.environ.get('S3_URL', 'https://s3-us-west-2.amazonaws.com/opinionated/')
+# the scaled down variants stored next to every image, the lists of posts show the thumbnails and the details of a
+# post the medium images
+IMAGE_VARIANTS = OrderedDict([('thumb', (320, 320)), ('medium', (800, 800))])
+# uploads larger than this are refused
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 20 * 1024 * 1024))
+# the browser uploads the images straight to s3, under UPLOAD_PREFIX/<user id>/, with forms signed for
+# UPLOAD_EXPIRES_IN seconds; the bucket should expire what is left there after a day
+UPLOAD_PREFIX = 'uploads'
+UPLOAD_EXPIRES_IN = int(os.environ.get('UPLOAD_EXPIRES_IN', 600))
+# the images of new posts are copied out of the uploads, with their variants, in the background once server.py
+# starts the pool
+upload_pool = UploadPool(bucket, workers=int(os.environ.get('UPLOAD_WORKERS', 4)),
+                         max_pending=int(os.environ.get('UPLOAD_QUEUE_SIZE', 100)), variants=IMAGE_VARIANTS)
+# objects are deleted from s3 with multi-object deletes of up to this many keys, the most s3 takes in one request
+S3_DELETE_BATCH_SIZE = 1000
 
 # define allowed file type for uploading
 ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'])
+ALLOWED_CONTENT_TYPES = set(mimetypes.types_map['.' + extension] for extension in ALLOWED_EXTENSIONS)
+# the media_state of a post or choice with an image; rows from before the images were uploaded in the background
+# have no state and count as ready
+MEDIA_PENDING = 'pending'
+MEDIA_READY = 'ready'
+MEDIA_FAILED = 'failed'
 POSTS_PER_PAGE = 20
+COMMENTS_PER_PAGE = 20
+SEARCH_RESULTS_PER_PAGE = 20
+FOLLOWS_PER_PAGE = 50
+# the most ids bound into a single IN clause, sqlite doesn't take more than 999 parameters per statement
+IN_CLAUSE_LIMIT = 500
+# authors with more followers than this are not fanned out to their followers' timelines on write; their posts are
+# merged into the followed feed when it is read instead
+FANOUT_FOLLOWER_LIMIT = int(os.environ.get('FANOUT_FOLLOWER_LIMIT', 5000))
+
+# vote results of the most recently viewed posts, valid for one version of the post
+results_cache = VersionedCache(max_entries=int(os.environ.get('RESULTS_CACHE_SIZE', 1000)))
+# the leaderboard of the most used tags is rebuilt at most every POPULAR_TAGS_TTL seconds (0 rebuilds it on every
+# request); it holds the top POPULAR_TAGS_SIZE tags
+POPULAR_TAGS_SIZE = int(os.environ.get('POPULAR_TAGS_SIZE', 50))
+popular_tags_cache = TimedCache(ttl=int(os.environ.get('POPULAR_TAGS_TTL', 60)))
+# the tag names the typeahead suggests, ranked by post count; new tags are added to it as they are created and it is
+# reloaded every TAG_INDEX_TTL seconds to follow the post counts
+tag_index = PrefixIndex(ttl=int(os.environ.get('TAG_INDEX_TTL', 300)))
 
 
 def allowed_file(filename):
@@ -38,6 +162,103 @@ def parse_location(unicode):
     else:
         return location
 
+def choice_label(choice_text, index):
+    """the label of a choice in the charts; choices without text are named after their position"""
+    if choice_text:
+        return str(choice_text)
+    return "choice" + str(index + 1)
+
+def chunks(items, size):
+    """splits a list into consecutive lists of at most size items"""
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+# voter attributes that the vote results can be broken down by, mapped to the function that turns the column value
+# into the key shown on the chart
+VOTER_DIMENSIONS = OrderedDict([('gender', str), ('location', parse_location), ('age_range', str)])
+
+
+##############################################################################
+# Cursor pagination
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class CursorPage(object):
+    """One page of a newest-first feed paginated by cursor instead of by page number. The cursors are opaque tokens
+    holding the (timestamp, id) of the first or last row of the page, so fetching the next page is an index range
+    scan from that row rather than an OFFSET, and no COUNT(*) is needed"""
+
+    def __init__(self, items, prev_cursor, next_cursor):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(direction, timestamp, row_id):
+    """direction is 'next' for the rows older than (timestamp, row_id) and 'prev' for the newer ones"""
+    return base64.urlsafe_b64encode("%s|%s|%d" % (direction, timestamp.strftime(CURSOR_TIME_FORMAT), row_id))
+
+
+def decode_cursor(cursor):
+    """returns the (direction, timestamp, row_id) of a cursor, or None if the cursor is not valid"""
+    try:
+        direction, timestamp, row_id = base64.urlsafe_b64decode(str(cursor)).split('|')
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(row_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def seek(query, direction, timestamp, row_id, timestamp_column, id_column):
+    """narrows a newest-first query to the rows after (timestamp, row_id) in direction 'next' (older rows, newest
+    first) or 'prev' (newer rows, oldest first)"""
+    if direction == 'prev':
+        query = query.filter(db.or_(timestamp_column > timestamp,
+                                    db.and_(timestamp_column == timestamp, id_column > row_id)))
+        return query.order_by(timestamp_column.asc(), id_column.asc())
+    query = query.filter(db.or_(timestamp_column < timestamp,
+                                db.and_(timestamp_column == timestamp, id_column < row_id)))
+    return query.order_by(timestamp_column.desc(), id_column.desc())
+
+
+def paginate_by_cursor(query, cursor=None, per_page=POSTS_PER_PAGE, timestamp_column=None, id_column=None):
+    """paginates a query newest first on (timestamp_column, id_column), by default the timestamp and id of the posts;
+    the rows returned must have attributes with the same names as the two columns. An invalid cursor gives the
+    first page"""
+    if timestamp_column is None:
+        timestamp_column, id_column = Post.timestamp, Post.post_id
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        query = seek(query, position[0], position[1], position[2], timestamp_column, id_column)
+    else:
+        query = query.order_by(timestamp_column.desc(), id_column.desc())
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if position and position[0] == 'prev':
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = position is not None, has_more
+
+    def cursor_at(direction, row):
+        return encode_cursor(direction, getattr(row, timestamp_column.key), getattr(row, id_column.key))
+
+    prev_cursor = cursor_at('prev', rows[0]) if rows and has_prev else None
+    next_cursor = cursor_at('next', rows[-1]) if rows and has_next else None
+    return CursorPage(rows, prev_cursor, next_cursor)
+
 
 ##############################################################################
 # Model definitions
@@ -56,6 +277,7 @@ class User(db.Model):
     age_range = db.Column(db.Integer)
     gender = db.Column(db.String)
     profile_pic = db.Column(db.String)
+    fanout_on_read = db.Column(db.Boolean, nullable=False, default=False, server_default='0')  # see FANOUT_FOLLOWER_LIMIT
     # fb_user_id = db
 
     # todo: need to decide if only allows for facebook login, if so, we could take out the password part
@@ -95,12 +317,9 @@ class User(db.Model):
         new_user = cls(user_id=user_id, email=email, password=password, user_name=user_name, location=location, about_me=about_me,
                        age_range=age_range, gender=gender, profile_pic=profile_pic)
         db.session.add(new_user)
-        db.session.commit()
+        commit()
         if friend_ids: # follow all facebook friends who are also users of the app automatically when log in
-            for friend_id in friend_ids:
-                friend  = User.get_user_by_id(friend_id)
-                if friend:
-                    new_user.follow(friend)
+            new_user.follow_friends(friend_ids)
 
         return new_user
 
@@ -120,6 +339,7 @@ class User(db.Model):
     #     return [friend.friend_id for friend in self.friendships]
 
     def update_user_info(self, user_name=None, age_range=None, gender=None, location=None, about_me=None, profile_pic=None):
+        profile = [getattr(self, dimension) for dimension in VOTER_DIMENSIONS]
         if user_name:
             if user_name != self.user_name:
                 self.user_name = user_name
@@ -138,20 +358,61 @@ class User(db.Model):
         if profile_pic:
             if profile_pic != self.profile_pic:
                 self.profile_pic = profile_pic
-        db.session.commit()
+        if profile != [getattr(self, dimension) for dimension in VOTER_DIMENSIONS]:
+            self.expire_voted_results()
+        commit()
+
+    def expire_voted_results(self):
+        """bumps the versions of the posts self voted on, so their results, which break the votes down by the
+        profile of the voters, are recomputed rather than patched from the buckets self was counted in"""
+        voted = db.session.query(Choice.post_id).join(Vote, Vote.choice_id == Choice.choice_id)\
+            .filter(Vote.user_id == self.user_id)
+        Post.query.filter(Post.post_id.in_(voted)).update({Post.version: Post.version + 1}, synchronize_session=False)
 
     def follow(self, user):
         if not self.is_following(user):
             f = Follow(follower_id=self.user_id, followed_id=user.user_id)
             db.session.add(f)
-            db.session.commit()
+            if not user.fanout_on_read:
+                if user.followers.count() > FANOUT_FOLLOWER_LIMIT:
+                    user.fanout_on_read = True
+                else:
+                    TimelineEntry.backfill(self.user_id, user.user_id)
+            commit()
+
+    def follow_friends(self, friend_ids):
+        """follows all the users among friend_ids that self isn't following yet. The friends are resolved, followed
+        and added to the timeline of self with a few set based statements per IN_CLAUSE_LIMIT ids and a single
+        commit, instead of a handful of queries and a commit per friend. Returns the ids of the newly followed users"""
+        friend_ids = sorted(set(friend_ids) - set([self.user_id]))
+        already_followed = db.exists().where(db.and_(Follow.follower_id == self.user_id,
+                                                     Follow.followed_id == User.user_id))
+        new_ids = []
+        for chunk in chunks(friend_ids, IN_CLAUSE_LIMIT):
+            new_ids.extend(user_id for (user_id,) in db.session.query(User.user_id)
+                           .filter(User.user_id.in_(chunk), ~already_followed))
+        if not new_ids:
+            return new_ids
+
+        now = datetime.utcnow()
+        db.session.execute(Follow.__table__.insert(),
+                           [{'follower_id': self.user_id, 'followed_id': followed_id, 'timestamp': now}
+                            for followed_id in new_ids])
+        for chunk in chunks(new_ids, IN_CLAUSE_LIMIT):
+            follower_count = db.select([db.func.count()]).where(Follow.followed_id == User.user_id).as_scalar()
+            User.query.filter(User.user_id.in_(chunk), User.fanout_on_read == False,
+                              follower_count > FANOUT_FOLLOWER_LIMIT)\
+                .update({'fanout_on_read': True}, synchronize_session=False)
+            TimelineEntry.backfill(self.user_id, chunk)
+        commit()
+        return new_ids
 
     def unfollow(self, user):
-        f = Follow.query.filter_by(followed_id=user.user_id).first()
-        print f
+        f = Follow.query.filter_by(follower_id=self.user_id, followed_id=user.user_id).first()
         if f:
             db.session.delete(f)
-            db.session.commit()
+            TimelineEntry.purge(self.user_id, user.user_id)
+            commit()
 
 
     def is_following(self, user):
@@ -161,35 +422,41 @@ class User(db.Model):
         return Follow.query.filter_by(Follow.follower_id==user.user_id, Follow.followed_id==self.user_id).first() is not None
 
 
+    def followers_query(self):
+        """query of (user, since) pairs of everyone following self, most recent first; a single join instead of a
+        lookup per follower"""
+        return User.query.add_columns(Follow.timestamp).join(Follow, Follow.follower_id == User.user_id)\
+            .filter(Follow.followed_id == self.user_id).order_by(Follow.timestamp.desc(), Follow.follower_id)
+
+    def followeds_query(self):
+        """query of (user, since) pairs of everyone self is following, most recent first"""
+        return User.query.add_columns(Follow.timestamp).join(Follow, Follow.followed_id == User.user_id)\
+            .filter(Follow.follower_id == self.user_id).order_by(Follow.timestamp.desc(), Follow.followed_id)
+
+    def get_followers_page(self, page=1, per_page=FOLLOWS_PER_PAGE):
+        """one page of the followers of self, the items are (user, since) pairs"""
+        return self.followers_query().paginate(page, per_page=per_page, error_out=False)
+
+    def get_followeds_page(self, page=1, per_page=FOLLOWS_PER_PAGE):
+        """one page of the users self is following, the items are (user, since) pairs"""
+        return self.followeds_query().paginate(page, per_page=per_page, error_out=False)
+
     def get_all_followers(self):
         """this function returns a dictionary of info about all followers with the user object as key and timestamp as
         value"""
-        follows = self.followers.all() #this returns the follow object where the followed_id is self
-        followers = {}
-        for follow in follows:
-            followers[User.get_user_by_id(follow.follower_id)] = follow.timestamp
-
-        return followers
-
+        return dict(self.followers_query().all())
 
     def get_all_followeds(self):
-        follows = self.followed.all()
-        followeds = {}
-        for follow in follows:
-            followeds[User.get_user_by_id(follow.followed_id)] = follow.timestamp
-        return followeds
+        return dict(self.followeds_query().all())
 
     def followed_posts(self):
         """gives a list all posts of users that self has been following"""
-        followeds = self.get_all_followeds() #gives a dictionary with the key as user object
-        followed_ids = [followed.user_id for followed in followeds]
-        posts = Post.query.filter(Post.author_id.in_(followed_ids)).order_by(Post.timestamp.desc()).all()
-        return posts
+        query, timestamp_column, id_column = TimelineEntry.get_posts_query(self.user_id, Post.query)
+        return query.order_by(timestamp_column.desc(), id_column.desc()).all()
 
-    def followed_posts_pagination(self, page):
-        followeds = self.get_all_followeds() #gives a dictionary with the key as user object
-        followed_ids = [followed.user_id for followed in followeds]
-        return Post.query.filter(Post.author_id.in_(followed_ids)).order_by(Post.timestamp.desc()).paginate(page, per_page=POSTS_PER_PAGE, error_out=False)
+    def followed_posts_page(self, cursor=None, per_page=POSTS_PER_PAGE):
+        query, timestamp_column, id_column = TimelineEntry.get_posts_query(self.user_id, Post.feed_query())
+        return paginate_by_cursor(query, cursor, per_page, timestamp_column, id_column)
 
 
 # class Friendship(db.Model):
@@ -220,8 +487,8 @@ class User(db.Model):
 class Follow(db.Model):
     __tablename__ = 'follows'
     follower_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id'), primary_key=True)
-    followed_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id'), primary_key=True)
-    timestamp = db.Column(db.TIMESTAMP, index=True, default=datetime.utcnow())
+    followed_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id'), primary_key=True, index=True)
+    timestamp = db.Column(db.TIMESTAMP, index=True, default=datetime.utcnow)
 
     @classmethod
     def get_follow_by_follower_id(cls, user_id):
@@ -232,6 +499,73 @@ class Follow(db.Model):
         return cls.query.filter(cls.followed_id==user_id).all()
 
 
+class TimelineEntry(db.Model):
+    """A post in the followed feed of a user. The entries are written when a post is created and when its author is
+    followed (fan-out on write), so reading the feed is one range scan over (user_id, timestamp, post_id)"""
+
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.post_id', ondelete='CASCADE'), primary_key=True)
+    author_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id', ondelete='CASCADE'), nullable=False)
+    timestamp = db.Column(db.TIMESTAMP, nullable=False)  # a copy of the timestamp of the post, to sort on
+
+    __table_args__ = (db.Index('ix_timelines_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id'),)
+
+    @classmethod
+    def fan_out(cls, post):
+        """adds a new post to the timelines of all the followers of its author, in one statement"""
+        fanout_on_read = db.exists().where(db.and_(User.user_id == post.author_id, User.fanout_on_read == True))
+        followers = db.select([Follow.follower_id, db.literal(post.post_id), db.literal(post.author_id),
+                               db.literal(post.timestamp)])\
+            .where(db.and_(Follow.followed_id == post.author_id, ~fanout_on_read))
+        db.session.execute(cls.__table__.insert().from_select(['user_id', 'post_id', 'author_id', 'timestamp'],
+                                                              followers))
+
+    @classmethod
+    def backfill(cls, follower_id, followed_ids):
+        """adds the existing posts of one or a list of newly followed authors to the timeline of the follower,
+        leaving out the authors that are fanned out on read"""
+        if not isinstance(followed_ids, (list, tuple)):
+            followed_ids = [followed_ids]
+        in_timeline = db.exists().where(db.and_(cls.user_id == follower_id, cls.post_id == Post.post_id))
+        posts = db.select([db.literal(follower_id), Post.post_id, Post.author_id, Post.timestamp])\
+            .select_from(db.join(Post.__table__, User.__table__, User.user_id == Post.author_id))\
+            .where(db.and_(Post.author_id.in_(followed_ids), User.fanout_on_read == False, ~in_timeline))
+        db.session.execute(cls.__table__.insert().from_select(['user_id', 'post_id', 'author_id', 'timestamp'],
+                                                              posts))
+
+    @classmethod
+    def purge(cls, follower_id, followed_id):
+        """removes the posts of an unfollowed author from the timeline of the follower"""
+        cls.query.filter(cls.user_id == follower_id, cls.author_id == followed_id).delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls):
+        """rebuilds every timeline from the follows and the posts"""
+        cls.query.delete(synchronize_session=False)
+        posts = db.select([Follow.follower_id, Post.post_id, Post.author_id, Post.timestamp])\
+            .select_from(db.join(Follow.__table__, Post.__table__, Follow.followed_id == Post.author_id)
+                         .join(User.__table__, User.user_id == Post.author_id))\
+            .where(User.fanout_on_read == False)
+        db.session.execute(cls.__table__.insert().from_select(['user_id', 'post_id', 'author_id', 'timestamp'],
+                                                              posts))
+        db.session.commit()
+
+    @classmethod
+    def get_posts_query(cls, user_id, query):
+        """narrows a query on posts down to the followed feed of a user; returns the query together with the
+        timestamp and id columns it should be ordered and paginated on. The posts of followed authors that are not
+        fanned out on write are merged in here, at the cost of paginating on the posts table instead of the timeline"""
+        unfanned_ids = [followed_id for (followed_id,) in db.session.query(Follow.followed_id)
+                        .join(User, User.user_id == Follow.followed_id)
+                        .filter(Follow.follower_id == user_id, User.fanout_on_read == True)]
+        if not unfanned_ids:
+            query = query.join(cls, cls.post_id == Post.post_id).filter(cls.user_id == user_id)
+            return query, cls.timestamp, cls.post_id
+        timeline = db.session.query(cls.post_id).filter(cls.user_id == user_id)
+        query = query.filter(db.or_(Post.post_id.in_(timeline), Post.author_id.in_(unfanned_ids)))
+        return query, Post.timestamp, Post.post_id
+
 
 class Comment(db.Model):
     """Comments left by users for a specific post"""
@@ -242,7 +576,10 @@ class Comment(db.Model):
     content = db.Column(db.Text, nullable=True)
     user_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.post_id'), nullable=False)
-    timestamp = db.Column(db.TIMESTAMP, index=True, default=datetime.utcnow())
+    timestamp = db.Column(db.TIMESTAMP, index=True, default=datetime.utcnow)
+
+    # for the cursor pagination of the comments of a post
+    __table_args__ = (db.Index('ix_comments_post_id_timestamp_comment_id', 'post_id', 'timestamp', 'comment_id'),)
 
     def __repr__(self):
         """Provide helpful representation when prints"""
@@ -252,13 +589,21 @@ class Comment(db.Model):
     def create(cls, content, user_id, post_id):
         new_comment = cls(content=content, user_id=user_id, post_id=post_id)
         db.session.add(new_comment)
-        db.session.commit()
+        Post.update_comment_count(post_id, 1)
+        search_index().add(post_id, [(content, 'C')])
+        commit()
         return new_comment
 
     @classmethod
     def get_comments_by_post_id(cls, post_id):
         return cls.query.filter_by(post_id=post_id).all()
 
+    @classmethod
+    def get_comments_page(cls, post_id, cursor=None, per_page=COMMENTS_PER_PAGE):
+        """a page of the comments on the post, newest first, with their authors joined in"""
+        query = cls.query.options(db.joinedload(cls.user)).filter(cls.post_id == post_id)
+        return paginate_by_cursor(query, cursor, per_page, timestamp_column=cls.timestamp, id_column=cls.comment_id)
+
     @classmethod
     def get_comment_by_comment_id(cls, comment_id):
         return cls.query.get(comment_id)
@@ -267,12 +612,13 @@ class Comment(db.Model):
     def delete_by_comment_id(cls, comment_id):
         comment = cls.get_comment_by_comment_id(comment_id)
         db.session.delete(comment)
-        db.session.commit()
+        Post.update_comment_count(comment.post_id, -1)
+        search_index().replace(comment.post_id, Post.search_fields(comment.post_id))  # the words can't be taken out
+        commit()
 
         flash('the comment has been deleted')
 
 
-
 class Post(db.Model):
     """Question posted by users that people voted on"""
 
@@ -282,8 +628,14 @@ class Post(db.Model):
     author_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id'), nullable=False)
     description = db.Column(db.Text)
     file_name = db.Column(db.String(250))  # user can also upload a file in question body
+    media_state = db.Column(db.String(10))  # MEDIA_PENDING until the image is uploaded
+    media_variants = db.Column(db.Boolean, nullable=False, default=False, server_default='0')  # see IMAGE_VARIANTS
     state = db.Column(db.Integer) # this can be null (undecided) or a specific choice id
-    timestamp = db.Column(db.TIMESTAMP, index=True, default=datetime.utcnow())
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # bumped by the votes triggers
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # kept up by Comment
+    timestamp = db.Column(db.TIMESTAMP, index=True, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_posts_timestamp_post_id', 'timestamp', 'post_id'),)  # for the cursor pagination
 
     comments = db.relationship("Comment", backref=db.backref("post"), cascade="all, delete, delete-orphan")
     choices = db.relationship("Choice", backref=db.backref("post"), cascade="all, delete, delete-orphan")
@@ -293,89 +645,177 @@ class Post(db.Model):
         """Return the post id and description when printed"""
         return "<Post post_id=%s, description=%s>" % (self.post_id, self.description)
 
+    @property
+    def media_ready(self):
+        """whether the image can be shown; False while it is uploading or if the upload failed"""
+        return self.media_state in (None, MEDIA_READY)
+
     @classmethod
+    @UnitOfWork()
     def create(cls, author_id, description, file_name, tag_list, choice_data):
-        # create the post first
-        # upload image to aws s3
+        """creates a post, in a unit of work of its own unless it is within one; file_name and the images in
+        choice_data are the keys of files the author uploaded straight to s3 with the forms of sign_upload(). Raises
+        InvalidUpload before anything is written if one of them isn't theirs, is too large or of a type not allowed"""
+        post_image = verify_upload(author_id, file_name) if file_name else None
+        choices = [(choice_text, verify_upload(author_id, choice_key) if choice_key else None)
+                   for choice_text, choice_key in choice_data]
 
+        # create the post first
         new_post = cls(author_id=author_id, description=description)
         db.session.add(new_post)
-        db.session.commit()
-
-        if file_name:
-            k1 = Key(bucket)
-            k1.key = hashlib.sha512(str(new_post.post_id)).hexdigest()
-            k1.set_contents_from_file(file_name)
-            k1.set_canned_acl('public-read')
-            new_post.file_name = k1.key
-            db.session.commit()
+        db.session.flush()  # the post, its tags and choices are all committed together at the end
+        TimelineEntry.fan_out(new_post)
+        copies = []  # the new images are copied from the uploads once the post is committed, pending until then
+        uploads = set()
+
+        def store_image(item, upload):
+            # the image is stored under the md5 of its content, and only copied if it isn't stored already
+            key_name = content_md5(upload)
+            media, needs_copy = Media.acquire(key_name)
+            item.file_name = key_name
+            item.media_state = media.state
+            item.media_variants = media.variants
+            uploads.add(upload.name)
+            if needs_copy:
+                copies.append((key_name, upload.name))
+
+        if post_image:
+            store_image(new_post, post_image)
 
         # if specified tags, create tags
-        if tag_list:
-            tag_names = tag_list.split(',')
-            for tag_name in tag_names:
-                tag = Tag.get_tag_by_name(tag_name)
-                if not tag:  # create a new tag if tag doesn't already exist
-                    tag = Tag.create(tag_name=tag_name)
-                TagPost.create(tag_id=tag.tag_id, post_id=new_post.post_id)
+        tag_names = tag_list.split(',') if tag_list else []
+        if tag_names:
+            tag_ids = Tag.resolve_tag_names(tag_names)
+            TagPost.create_many(post_id=new_post.post_id, tag_ids=tag_ids)
 
         # create choices
-        for choice_text, choice_file in choice_data:
-            if choice_file:
-                if allowed_file(choice_file.filename):
-                    new_choice = Choice.create(choice_text=choice_text, post_id=new_post.post_id)
-
-                    # upload image to aws s3
-                    k = Key(bucket)
-                    k.key = hashlib.sha512(str(new_choice.choice_id)).hexdigest()
-                    k.set_contents_from_file(choice_file)
-                    k.set_canned_acl('public-read')
-
-                    # stored the hashed file id as url
-                    new_choice.file_name = k.key
-                    db.session.commit()
-
-                else:
-                    flash('the file type you uploaded is not valid')
-            else:
-                Choice.create(choice_text=choice_text, post_id=new_post.post_id)
+        for choice_text, choice_image in choices:
+            new_choice = Choice(choice_text=choice_text, post_id=new_post.post_id)
+            db.session.add(new_choice)
+            if choice_image:
+                store_image(new_choice, choice_image)
+
+        search_index().add(new_post.post_id, [(description, 'A'), (u' '.join(tag_names), 'A'),
+                                              (u' '.join(text or u'' for text, image in choices), 'B')])
+
+        # the uploads of images stored already aren't needed
+        unused = uploads.difference(upload_key for key_name, upload_key in copies)
+        PendingDeletion.queue(unused)
+        commit()
+
+        def store_copies():
+            for key_name, upload_key in copies:
+                upload_pool.submit_copy(key_name, upload_key, on_done=media_uploaded)
+            if unused:
+                deletion_flusher.notify()
+        UnitOfWork.after_commit(store_copies)
         return new_post
 
 
     def update_decision(self, choice_id):
         self.state = choice_id
-        db.session.commit()
+        commit()
 
 
     @classmethod
     def delete_by_post_id(cls, post_id):
-        # deleting the images from aws for the choices
-        choices = Choice.get_choices_by_post_id(post_id)
-        for choice in choices:
-            k = Key(bucket)
-            k.key = hashlib.sha512(str(choice.choice_id)).hexdigest()
-            bucket.delete_key(k)
-
         post = cls.get_post_by_id(post_id)
-        #deleting the image from the post description from aws
-        k1 = Key(bucket)
-        k1.key = hashlib.sha512(str(post.post_id)).hexdigest()
-        bucket.delete_key(k1)
-
+        # the images nothing else refers to are deleted from aws in the background, once the post is gone
+        images = [choice.file_name for choice in post.choices if choice.file_name]
+        if post.file_name:
+            images.append(post.file_name)
+        originals = Media.release(images)
+        key_names = originals + [variant_key(key_name, variant) for key_name in originals for variant in IMAGE_VARIANTS]
+        PendingDeletion.queue(key_names)
+
+        TimelineEntry.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+        Tag.update_post_counts([tagpost.tag_id for tagpost in post.tagposts], -1)
+        search_index().drop(post_id)
         db.session.delete(post)
-        db.session.commit()
+        commit()
+        if key_names:
+            UnitOfWork.after_commit(deletion_flusher.notify)
 
         flash('Your post has been deleted')
 
 
     @classmethod
-    def get_all_posts(cls):
-        return cls.query.order_by(Post.timestamp.desc()).all()
+    def update_comment_count(cls, post_id, change):
+        """adds change to the comment count of the post, in one statement"""
+        cls.query.filter(cls.post_id == post_id)\
+            .update({cls.comment_count: cls.comment_count + change}, synchronize_session=False)
+
+    @classmethod
+    def reconcile_comment_counts(cls):
+        """rebuilds the maintained comment counts from the comments table; returns the number of posts updated"""
+        comments = db.select([db.func.count(Comment.comment_id)]).where(Comment.post_id == cls.post_id).as_scalar()
+        updated = cls.query.update({cls.comment_count: comments}, synchronize_session=False)
+        db.session.commit()
+        return updated
+
+    @classmethod
+    def search_fields(cls, post_id):
+        """what is indexed of the post for the search, read from the database; see search.py"""
+        post = db.session.query(cls.description).filter(cls.post_id == post_id).first()
+        tags = db.session.query(Tag.tag_name).join(TagPost).filter(TagPost.post_id == post_id)
+        choices = db.session.query(Choice.choice_text).filter(Choice.post_id == post_id)
+        comments = db.session.query(Comment.content).filter(Comment.post_id == post_id)
+        return [(post.description if post else None, 'A'), (u' '.join(name for name, in tags), 'A'),
+                (u' '.join(text or u'' for text, in choices), 'B'), (u' '.join(text or u'' for text, in comments), 'C')]
+
+    @classmethod
+    def search(cls, text, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+        """the posts matching the words searched for, best matches first, as a page of a Pagination"""
+        page = max(page, 1)
+        post_ids, total = search_index().search(text, offset=(page - 1) * per_page, limit=per_page)
+        posts = dict((post.post_id, post) for post in cls.feed_query().filter(cls.post_id.in_(post_ids))) \
+            if post_ids else {}
+        return Pagination(None, page, per_page, total, [posts[post_id] for post_id in post_ids if post_id in posts])
 
     @classmethod
-    def get_all_posts_pagination(cls, page):
-        return cls.query.order_by(Post.timestamp.desc()).paginate(page, per_page=POSTS_PER_PAGE, error_out=False)
+    def rebuild_search_index(cls, batch_size=100):
+        """indexes every post again, e.g. after the search index was added to an existing database; returns the
+        number of posts indexed"""
+        post_ids = [post_id for post_id, in db.session.query(cls.post_id).order_by(cls.post_id)]
+        for batch in chunks(post_ids, batch_size):
+            for post_id in batch:
+                search_index().replace(post_id, cls.search_fields(post_id))
+            db.session.commit()
+        return len(post_ids)
 
+    @classmethod
+    def feed_query(cls):
+        """the query the post lists are built from; the authors are joined in and the choices and tags are loaded
+        with one extra query each, so a page costs the same three queries however many posts it shows"""
+        return cls.query.options(db.joinedload(cls.author), db.subqueryload(cls.choices), db.subqueryload(cls.tags))
+
+    @classmethod
+    def get_all_posts_page(cls, cursor=None, per_page=POSTS_PER_PAGE):
+        return paginate_by_cursor(cls.feed_query(), cursor, per_page)
+
+
+    @classmethod
+    def get_feed_query(cls, feed):
+        """the posts of a feed descriptor, which is 'all', 'followed:<user_id>', 'tag:<tag name>' or
+        'author:<user_id>'; anything else is taken as 'all'"""
+        kind, _, value = (feed or 'all').partition(':')
+        try:
+            if kind == 'followed':
+                followed_ids = db.session.query(Follow.followed_id).filter(Follow.follower_id == int(value))
+                return cls.query.filter(cls.author_id.in_(followed_ids))
+            if kind == 'author':
+                return cls.query.filter(cls.author_id == int(value))
+        except ValueError:
+            return cls.query
+        if kind == 'tag':
+            return cls.query.filter(cls.tags.any(tag_name=value))
+        return cls.query
+
+    def get_neighbour_in_feed(self, feed, direction):
+        """the post shown right before ('prev', the newer one) or after ('next', the older one) this post in the feed,
+        found with a single row index query; None at either end of the feed"""
+        return seek(Post.get_feed_query(feed), direction, self.timestamp, self.post_id, Post.timestamp,
+                    Post.post_id).first()
 
     @classmethod
     def get_post_by_id(cls, post_id):
@@ -383,24 +823,41 @@ class Post(db.Model):
 
     @classmethod
     def get_posts_by_author_id(cls, author_id):
-        return cls.query.filter_by(author_id=author_id).order_by(Post.timestamp.desc()).all()
-
-    @classmethod
-    def get_posts_by_tag(cls, tag):
-        return cls.query.filter(cls.tags.any(tag_name=tag)).order_by(Post.timestamp.desc()).all()
+        return cls.feed_query().filter_by(author_id=author_id).order_by(Post.timestamp.desc()).all()
 
     @classmethod
-    def get_posts_by_tag_pagination(cls, tag, page):
-        return cls.query.filter(cls.tags.any(tag_name=tag)).order_by(Post.timestamp.desc()).paginate(page, per_page=POSTS_PER_PAGE, error_out=False)
+    def get_posts_by_tag_page(cls, tag, cursor=None, per_page=POSTS_PER_PAGE):
+        return paginate_by_cursor(cls.feed_query().filter(cls.tags.any(tag_name=tag)), cursor, per_page)
+
+    def _choice_rows(self):
+        """the choices of this post in display order, with their maintained vote counts"""
+        return db.session.query(Choice.choice_id, Choice.choice_text, Choice.vote_count)\
+            .filter(Choice.post_id == self.post_id)\
+            .order_by(Choice.choice_id).all()
+
+    @staticmethod
+    def _tally(aggregates):
+        vote_dict = dict(zip(aggregates['choice_ids'], aggregates['counts']))
+        chart_lst = [["Choice", "Votes"]]
+        for label, count in zip(aggregates['labels'], aggregates['counts']):
+            chart_lst.append([label, count])
+        return vote_dict, sum(aggregates['counts']), chart_lst
+
+    def tally_votes(self):
+        """reads the vote counts maintained on the choices of this post, so it costs one row per choice however many
+        votes there are; returns the vote dictionary, the total votes and the rows of the doughnut chart"""
+        rows = self._choice_rows()
+        return self._tally({'choice_ids': [choice_id for choice_id, choice_text, count in rows],
+                            'labels': [choice_label(row[1], index) for index, row in enumerate(rows)],
+                            'counts': [count for choice_id, choice_text, count in rows]})
 
     def count_votes(self):
-        choices = Choice.get_choices_by_post_id(self.post_id)
-        vote_dict = {}  # vote count dictionary that maps choice to number of votes
-        doughnut_chart_dict = self.doughnut_chart()
-        for choice in choices:
-            vote_dict[choice.choice_id] = len(choice.get_votes())
-        total_votes = sum(vote_dict.values())
-        return vote_dict, total_votes, doughnut_chart_dict
+        return self.tally_votes()
+
+    @property
+    def total_votes(self):
+        """the number of votes on the post, summed from the vote counts of its choices"""
+        return sum(choice.vote_count for choice in self.choices)
 
     def get_voters(self):
         voters = db.session.query(User).join(Vote).join(Choice).filter(Vote.choice_id==Choice.choice_id, Vote.user_id==User.user_id, self.post_id==Choice.post_id).all()
@@ -408,105 +865,170 @@ class Post(db.Model):
 
 
     def doughnut_chart(self):
-        choices = Choice.get_choices_by_post_id(self.post_id)
-        chart_lst = [["Choice", "Votes"]]
-        for choice in choices:
-             if choice.choice_text:
-                 chart_lst.append([str(choice.choice_text), len(choice.get_votes())])
-             else:
-                 index = choices.index(choice)
-                 key = "choice" + str(index + 1)
-                 chart_lst.append([key, len(choice.get_votes())])
-
+        vote_dict, total_votes, chart_lst = self.tally_votes()
         return chart_lst
 
-    def bar_chart_gender(self):
-        choices = Choice.get_choices_by_post_id(self.post_id)
-        chart_lst = [["Choices", {"role": 'annotation'}]]
-        voters = self.get_voters() # the voters for this post
-        female_voters = set([voter for voter in voters if voter.gender=="female"])
-        male_voters = set([voter for voter in voters if voter.gender=="male"])
-        choice_dict = {}
-        for choice in choices:
-            if choice.choice_text:
-                text = str(choice.choice_text)
-            else:
-                text = "choice " + str(choices.index(choice) + 1)
-            chart_lst[0].insert(choices.index(choice) + 1, text)
-            voters = set(choice.get_voters())
-            female = len(female_voters.intersection(voters))
-            male = len(male_voters.intersection(voters))
-            choice_dict[choices.index(choice)] = (female, male)
-
-        chart_lst.append(["Female", choice_dict[0][0], choice_dict[1][0], ""])
-        chart_lst.append(["Male", choice_dict[0][1], choice_dict[1][1], ""])
-
-        return chart_lst
+    def cross_tab_votes(self, *dimensions):
+        """counts the votes on this post by choice and by the given voter attributes (see VOTER_DIMENSIONS) with one
+        grouped query; returns the choice labels and a dictionary that maps each dimension to a matrix of
+        {attribute value: [number of votes for each choice]}"""
+        return self._cross_tab(self._choice_rows(), dimensions)
+
+    def _cross_tab(self, choices, dimensions):
+        labels = [choice_label(choice[1], index) for index, choice in enumerate(choices)]
+        position = dict((choice[0], index) for index, choice in enumerate(choices))
+
+        columns = [getattr(User, dimension) for dimension in dimensions]
+        rows = db.session.query(Vote.choice_id, db.func.count(Vote.vote_id), *columns)\
+            .join(User, User.user_id == Vote.user_id)\
+            .join(Choice, Choice.choice_id == Vote.choice_id)\
+            .filter(Choice.post_id == self.post_id)\
+            .group_by(Vote.choice_id, *columns).all()
+
+        matrices = dict((dimension, {}) for dimension in dimensions)
+        for row in rows:
+            choice_id, count = row[0], row[1]
+            for dimension, value in zip(dimensions, row[2:]):
+                if value is None:  # voters who didn't share this attribute are left out of its chart
+                    continue
+                key = VOTER_DIMENSIONS[dimension](value)
+                counts = matrices[dimension].setdefault(key, [0] * len(labels))
+                counts[position[choice_id]] += count
+        return labels, matrices
+
+    def voter_charts(self):
+        """builds the gender, location and age charts from a single cross tab of the voters"""
+        cross_tab = self.cross_tab_votes(*VOTER_DIMENSIONS)
+        return self.bar_chart_gender(cross_tab), self.count_votes_by_location(cross_tab), \
+               self.count_votes_by_age(cross_tab)
+
+    def aggregate_votes(self):
+        """reads everything the vote results are drawn from: the vote count of every choice and the cross tab of the
+        voters by all the VOTER_DIMENSIONS"""
+        choices = self._choice_rows()
+        labels, cross_tab = self._cross_tab(choices, VOTER_DIMENSIONS)
+        return {'choice_ids': [choice[0] for choice in choices],
+                'labels': labels,
+                'counts': [choice[2] for choice in choices],
+                'cross_tab': cross_tab}
+
+    def render_results(self, aggregates):
+        """turns the vote aggregates into the vote counts and the charts shown on the post details page"""
+        vote_dict, total_votes, chart_dict = self._tally(aggregates)
+        cross_tab = (aggregates['labels'], aggregates['cross_tab'])
+        return {'vote_dict': vote_dict,
+                'total_votes': total_votes,
+                'chart_dict': chart_dict,
+                'bar_chart_gender': self.bar_chart_gender(cross_tab),
+                'geochart': self.count_votes_by_location(cross_tab),
+                'bar_chart_age': self.count_votes_by_age(cross_tab)}
+
+    def get_results(self):
+        """returns the vote results of the post; they are only recomputed when the version of the post has changed
+        since they were cached, i.e. after a vote on it"""
+        aggregates = results_cache.get(self.post_id, self.version)
+        if aggregates is None:
+            aggregates = self.aggregate_votes()
+            # a vote committed since the version was read is counted already, and would be counted again by
+            # apply_vote_to_results, so the aggregates are only cached when the version is still the same
+            current = db.session.query(Post.version).filter(Post.post_id == self.post_id).scalar()
+            if current == self.version:
+                results_cache.set(self.post_id, self.version, aggregates)
+        return self.render_results(aggregates)
+
+    def apply_vote_to_results(self, voter, old_choice_id, new_choice_id, old_version):
+        """patches the cached results after the voter moved their vote from old_choice_id (None for a new vote) to
+        new_choice_id; old_version is the version of the post read before the vote was written. The patch is only
+        applied when that vote is the one write since then, otherwise the cached results are dropped"""
+        if self.version != old_version + 1:
+            results_cache.invalidate(self.post_id)
+            return
+        results_cache.update(self.post_id, old_version, self.version,
+                             lambda aggregates: self._apply_vote(aggregates, voter, old_choice_id, new_choice_id))
+
+    @staticmethod
+    def _apply_vote(aggregates, voter, old_choice_id, new_choice_id):
+        for choice_id, step in ((old_choice_id, -1), (new_choice_id, 1)):
+            if choice_id is None:
+                continue
+            position = aggregates['choice_ids'].index(choice_id)
+            aggregates['counts'][position] += step
+            for dimension, matrix in aggregates['cross_tab'].items():
+                value = getattr(voter, dimension)
+                if value is None:
+                    continue
+                key = VOTER_DIMENSIONS[dimension](value)
+                counts = matrix.setdefault(key, [0] * len(aggregates['choice_ids']))
+                counts[position] += step
+                if not any(counts):
+                    del matrix[key]
+        return aggregates
+
+    @staticmethod
+    def results_payload(results):
+        """the vote results the way the post details page redraws its charts with them: [vote_dict, the share of
+        the votes per choice, total_votes, chart_dict, bar_chart_gender, geochart, bar_chart_age]"""
+        vote_dict, total_votes = results['vote_dict'], results['total_votes']
+        total_votes_percent = dict((choice_id, float(count) / total_votes if total_votes else 0)
+                                   for choice_id, count in vote_dict.items())
+        return [vote_dict, total_votes_percent, total_votes, results['chart_dict'], results['bar_chart_gender'],
+                results['geochart'], results['bar_chart_age']]
 
+    @classmethod
+    def get_versions(cls, post_ids):
+        """the current version of each of the posts, as a dict of post_id -> version; deleted posts are left out"""
+        versions = {}
+        for batch in chunks(post_ids, IN_CLAUSE_LIMIT):
+            versions.update(db.session.query(cls.post_id, cls.version).filter(cls.post_id.in_(batch)).all())
+        return versions
 
-    # todo: this method may need to be replaced by a new table between user and post to achieve better performance
-
-    def count_votes_by_location(self):
-        choices = Choice.get_choices_by_post_id(self.post_id)
-        chart_lst = [["City"]]
-        voters = self.get_voters()
-        location_dict = {} # a dictionary with key as location, and a set of user objects as values
-        for voter in voters:
-            location = parse_location(voter.location)
-            if location not in location_dict and location != None:
-                location_dict[location] = set([voter])
-            elif location in location_dict:
-                location_dict[location].add(voter)
-        print location_dict, "this is the location dict"
-
-        for choice in choices:
-            if choice.choice_text:
-                text = str(choice.choice_text)
-            else:
-                text = "choice" + str(choices.index(choice) + 1)
-            chart_lst[0].insert(choices.index(choice) + 1, text)
-
-        for location in location_dict:
-            temp_list = [location]
-            for choice in choices:
-                voters = set(choice.get_voters())
-                count = len(location_dict[location].intersection(voters))
-                temp_list.append(count)
-
-            chart_lst.append(temp_list)
+    @classmethod
+    def render_live_results(cls, post_id):
+        """the payload of the results pushed to the pages showing the post"""
+        return json.dumps(cls.results_payload(cls.query.get(post_id).get_results()))
+
+    def results_for(self, voter):
+        """the vote results as the voter sees them: the vote they just made counts even while it is still waiting in
+        the vote buffer"""
+        buffered = vote_buffer.pending((voter.user_id, self.post_id))
+        stored = self.check_choice_on_post_by_user_id(voter.user_id) if buffered else None
+        if not buffered or buffered[2] == stored or buffered[2] not in [c.choice_id for c in self.choices]:
+            return self.get_results()
+        self.get_results()  # makes sure the aggregates are cached
+        aggregates = copy.deepcopy(results_cache.get(self.post_id, self.version))
+        return self.render_results(self._apply_vote(aggregates, voter, stored, buffered[2]))
+
+    def bar_chart_gender(self, cross_tab=None):
+        labels, matrices = cross_tab or self.cross_tab_votes('gender')
+        chart_lst = [["Choices"] + labels + [{"role": 'annotation'}]]
+        for gender in ("female", "male"):
+            counts = matrices['gender'].get(gender, [0] * len(labels))
+            chart_lst.append([gender.capitalize()] + counts + [""])
         return chart_lst
 
-    def count_votes_by_age(self):
-        choices = Choice.get_choices_by_post_id(self.post_id)
-        chart_lst = [["Age group"]]
-        voters = self.get_voters()
-        age_dict = {}
-        for voter in voters:
-            age = str(voter.age_range)
-            if age not in age_dict and age != None:
-                age_dict[age] = set([voter])
-            elif age in age_dict:
-                age_dict[age].add(voter)
-        for choice in choices:
-            if choice.choice_text:
-                text = str(choice.choice_text)
-            else:
-                text = "choice" + str(choices.index(choice) + 1)
-            chart_lst[0].insert(choices.index(choice) + 1, text)
-
-        for age in age_dict:
-            temp_list = [age]
-            for choice in choices:
-                voters = set(choice.get_voters())
-                count = len(age_dict[age].intersection(voters))
-                temp_list.append(count)
-            chart_lst.append(temp_list)
+    def count_votes_by_location(self, cross_tab=None):
+        labels, matrices = cross_tab or self.cross_tab_votes('location')
+        chart_lst = [["City"] + labels]
+        for location in sorted(matrices['location']):
+            chart_lst.append([location] + matrices['location'][location])
         return chart_lst
 
+    def count_votes_by_age(self, cross_tab=None):
+        labels, matrices = cross_tab or self.cross_tab_votes('age_range')
+        chart_lst = [["Age group"] + labels]
+        for age in sorted(matrices['age_range']):
+            chart_lst.append([age] + matrices['age_range'][age])
+        return chart_lst
 
+    def voted_choice(self, user_id):
+        """the choice the user voted for, counting the vote still waiting in the vote buffer; None if they didn't"""
+        buffered = vote_buffer.pending((user_id, self.post_id))
+        if buffered:
+            return buffered[2]
+        return self.check_choice_on_post_by_user_id(user_id)
 
     def check_choice_on_post_by_user_id(self, user_id):
-        choice = db.session.query(Choice.choice_id).join(Vote).filter(Choice.post_id==self.post_id, Vote.user_id==user_id).first()
+        choice = db.session.query(Vote.choice_id).filter(Vote.post_id==self.post_id, Vote.user_id==user_id).first()
         if choice:
             # the vote will give you a tuple, so we need to use index to grab out the element
             return choice[0]
@@ -518,11 +1040,15 @@ class Vote(db.Model):
     """
 
     __tablename__ = 'votes'
+    # a user has one vote per post, which cast() moves from choice to choice
+    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='votes_user_post_key'),)
 
     vote_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.BigInteger, db.ForeignKey('users.user_id'), nullable=False)
     choice_id = db.Column(db.Integer, db.ForeignKey('choices.choice_id'), nullable=False)
-    timestamp = db.Column(db.TIMESTAMP, default=datetime.utcnow())
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.post_id'), nullable=False)  # the post of the choice
+    previous_choice_id = db.Column(db.Integer)  # the choice the vote was last moved from, reported by cast()
+    timestamp = db.Column(db.TIMESTAMP, default=datetime.utcnow)
 
     def __repr__(self):
         """Return the post id and description when printed"""
@@ -530,14 +1056,60 @@ class Vote(db.Model):
 
     @classmethod
     def create(cls, user_id, choice_id):
-        new_vote = cls(user_id=user_id, choice_id=choice_id)
+        post_id = db.select([Choice.post_id]).where(Choice.choice_id == choice_id).as_scalar()
+        new_vote = cls(user_id=user_id, choice_id=choice_id, post_id=post_id)
         db.session.add(new_vote)
-        db.session.commit()
+        commit()
         return new_vote
 
+    @classmethod
+    def cast(cls, user_id, post_id, choice_id):
+        """records the vote of the user on the post for choice_id, whether they voted on the post before or not, with a
+        single upsert that the unique (user_id, post_id) constraint keeps from ever writing two votes; a choice that
+        isn't one of the post's is ignored. Returns (written, previous_choice_id): written is False if the vote was
+        for that choice already, previous_choice_id is the choice the vote was moved from, None for a first vote.
+        Needs PostgreSQL 9.5 or SQLite 3.35 and up."""
+        result = db.session.execute(VOTE_UPSERT, {'user_id': user_id, 'post_id': post_id, 'choice_id': choice_id,
+                                                  'timestamp': datetime.utcnow()})
+        # sqlite describes no columns at all when RETURNING has no row
+        row = result.first() if result.returns_rows else None
+        commit()
+        if row is None:
+            return False, None
+        return True, row[0]
+
+    @classmethod
+    def cast_many(cls, votes):
+        """casts votes like cast(), with one upsert per BULK_VOTE_ROWS votes and a single commit; votes is a list of
+        [user_id, post_id, choice_id, time as VOTE_TIME_FORMAT] with at most one vote per user and post. None of them
+        is cast if one fails"""
+        try:
+            for chunk in chunks(list(votes), BULK_VOTE_ROWS):
+                rows, params, timestamps = [], {}, []
+                for number, (user_id, post_id, choice_id, timestamp) in enumerate(chunk):
+                    rows.append("(:user_id%d, :post_id%d, :choice_id%d, :timestamp%d)" % ((number,) * 4))
+                    params.update({'user_id%d' % number: user_id, 'post_id%d' % number: post_id,
+                                   'choice_id%d' % number: choice_id,
+                                   'timestamp%d' % number: datetime.strptime(timestamp, VOTE_TIME_FORMAT)})
+                    timestamps.append(db.bindparam('timestamp%d' % number, type_=db.TIMESTAMP))
+                db.session.execute(db.text(VOTE_BULK_UPSERT % ", ".join(rows)).bindparams(*timestamps), params)
+            commit()
+        except Exception:
+            db.session.rollback()  # for the buffer to retry them on a clean session
+            raise
+
+    @classmethod
+    def cast_later(cls, user_id, post_id, choice_id):
+        """queues the vote in the vote buffer, to be cast with the next bulk upsert; Post.voted_choice() and
+        Post.results_for() show it to the voter meanwhile. Casts it right away if the buffer isn't started"""
+        vote = [user_id, post_id, choice_id, datetime.utcnow().strftime(VOTE_TIME_FORMAT)]
+        if vote_buffer.add((user_id, post_id), vote):
+            vote_flusher.notify()
+
     @classmethod
     def get_votes_by_user_id(cls, user_id):
-        return cls.query.filter_by(user_id=user_id).order_by(Vote.timestamp.desc()).all()
+        return cls.query.filter_by(user_id=user_id).options(db.joinedload(cls.choice).joinedload(Choice.post))\
+            .order_by(Vote.timestamp.desc()).all()
 
     @classmethod
     def get_votes_by_post_id(cls, post_id):
@@ -549,7 +1121,7 @@ class Vote(db.Model):
 
     @classmethod
     def get_vote_by_post_and_user_id(cls, post_id, user_id):
-        vote = db.session.query(Vote.vote_id).join(Choice).filter(Choice.post_id==post_id, Vote.user_id==user_id).first()
+        vote = db.session.query(Vote.vote_id).filter(Vote.post_id==post_id, Vote.user_id==user_id).first()
         if vote:
             return vote[0]
 
@@ -559,11 +1131,76 @@ class Vote(db.Model):
         return cls.query.get(vote_id)
 
 
+    @classmethod
+    def reconcile_post_ids(cls):
+        """fills in the post of the votes from before votes had one, and deletes all but the latest vote of a user on
+        a post, left over from double clicks; returns the number of votes deleted"""
+        post_id = db.select([Choice.post_id]).where(Choice.choice_id == cls.choice_id).as_scalar()
+        cls.query.filter(cls.post_id == None).update({cls.post_id: post_id}, synchronize_session=False)
+        latest = db.session.query(db.func.max(cls.vote_id)).group_by(cls.user_id, cls.post_id).subquery()
+        deleted = cls.query.filter(~cls.vote_id.in_(latest)).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
     @classmethod
     def update_vote(cls, vote_id, new_choice):
         vote = cls.get_vote_by_vote_id(vote_id)
         vote.choice_id = new_choice
-        db.session.commit()
+        commit()
+
+# the statement behind Vote.cast(): inserts the vote, or moves the existing vote of the user on the post to the new
+# choice; the vote triggers update the counts and the version of the post either way. It returns no row when the vote
+# was for that choice already, or the choice isn't one of the post's
+VOTE_UPSERT = db.text("""
+    INSERT INTO votes (user_id, post_id, choice_id, timestamp)
+    SELECT :user_id, :post_id, :choice_id, :timestamp FROM choices WHERE choice_id = :choice_id AND post_id = :post_id
+    ON CONFLICT (user_id, post_id) DO UPDATE
+    SET previous_choice_id = votes.choice_id, choice_id = excluded.choice_id, timestamp = excluded.timestamp
+    WHERE votes.choice_id != excluded.choice_id
+    RETURNING previous_choice_id""").bindparams(db.bindparam('timestamp', type_=db.TIMESTAMP))
+
+# the statement behind Vote.cast_many(), the same upsert for the rows of a VALUES list, whose columns are named
+# column1, column2... by both sqlite and postgresql
+VOTE_BULK_UPSERT = """
+    INSERT INTO votes (user_id, post_id, choice_id, timestamp)
+    SELECT vote.column1, vote.column2, vote.column3, vote.column4 FROM (VALUES %s) AS vote, choices
+    WHERE choices.choice_id = vote.column3 AND choices.post_id = vote.column2
+    ON CONFLICT (user_id, post_id) DO UPDATE
+    SET previous_choice_id = votes.choice_id, choice_id = excluded.choice_id, timestamp = excluded.timestamp
+    WHERE votes.choice_id != excluded.choice_id"""
+# the votes per statement of a bulk upsert, 4 parameters each within the 999 sqlite takes
+BULK_VOTE_ROWS = 200
+VOTE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# when VOTE_BUFFER_SIZE is set, the server starts the vote buffer (see start_vote_buffer()) and the votes are written
+# behind: they are upserted in bulk once VOTE_BUFFER_SIZE votes are waiting, or every VOTE_BUFFER_INTERVAL seconds,
+# and logged to VOTE_BUFFER_LOG if set, from which the votes not written yet are replayed after a crash
+VOTE_BUFFER_SIZE = int(os.environ.get('VOTE_BUFFER_SIZE', 0))
+VOTE_BUFFER_LOG = os.environ.get('VOTE_BUFFER_LOG')
+# the votes that kept failing, e.g. on a post deleted meanwhile, are given up after a few flushes and kept here
+VOTE_DEAD_LETTER_LOG = os.environ.get('VOTE_DEAD_LETTER_LOG', VOTE_BUFFER_LOG and VOTE_BUFFER_LOG + '.dead')
+vote_buffer = WriteBuffer(Vote.cast_many, max_size=VOTE_BUFFER_SIZE or 500, log_path=VOTE_BUFFER_LOG,
+                          fsync=os.environ.get('VOTE_BUFFER_FSYNC') == '1', dead_letter_path=VOTE_DEAD_LETTER_LOG,
+                          transient=(OperationalError,))
+vote_flusher = Flusher(vote_buffer.flush, interval=float(os.environ.get('VOTE_BUFFER_INTERVAL', 1)))
+
+
+def start_vote_buffer(app, per_process=False):
+    """has the votes written behind from now on, by a flusher within the context of app, starting with the votes
+    left in the log. The servers of several processes, e.g. gunicorn's workers, pass per_process: each process logs
+    to VOTE_BUFFER_LOG suffixed with its pid then, and adopts the logs of the processes gone before it"""
+    adopt = ()
+    if VOTE_BUFFER_LOG and per_process:
+        vote_buffer.log_path = process_log_path(VOTE_BUFFER_LOG)
+        adopt = orphaned_logs(VOTE_BUFFER_LOG)
+    vote_buffer.start(adopt)
+    vote_flusher.start(app)
+    atexit.register(vote_flusher.run_once)  # and write the votes still waiting at exit
+
+# the results pushed to the open post details pages, at most LIVE_RESULTS_RATE times a second per post
+LIVE_RESULTS_RATE = float(os.environ.get('LIVE_RESULTS_RATE', 2))
+live_results = ResultsHub(Post.get_versions, Post.render_live_results, rate=LIVE_RESULTS_RATE)
+
 
 class Choice(db.Model):
     """ Files (images, videos, audio etc) associated with specific post """
@@ -573,7 +1210,10 @@ class Choice(db.Model):
     choice_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     choice_text = db.Column(db.Text)
     file_name = db.Column(db.String(250))  # this is in fact the image url
+    media_state = db.Column(db.String(10))  # MEDIA_PENDING until the image is uploaded
+    media_variants = db.Column(db.Boolean, nullable=False, default=False, server_default='0')  # see IMAGE_VARIANTS
     post_id = db.Column(db.Integer, db.ForeignKey('posts.post_id'), nullable=False)
+    vote_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # kept up to date by the votes triggers
 
     votes = db.relationship("Vote", backref=db.backref("choice"), cascade="all, delete, delete-orphan")
 
@@ -582,11 +1222,17 @@ class Choice(db.Model):
         return "<Choice choice_text=%s, file_name=%s, post_id=%s>" % \
                (self.choice_text, self.file_name, self.post_id)
 
+    @property
+    def media_ready(self):
+        """whether the image can be shown; False while it is uploading or if the upload failed"""
+        return self.media_state in (None, MEDIA_READY)
+
     @classmethod
     def create(cls, choice_text, post_id, file_name=None):
         new_choice = cls(choice_text=choice_text, post_id=post_id, file_name=file_name)
         db.session.add(new_choice)
-        db.session.commit()
+        search_index().add(post_id, [(choice_text, 'B')])
+        commit()
         return new_choice
 
     @classmethod
@@ -604,6 +1250,18 @@ class Choice(db.Model):
         voters = db.session.query(User).join(Vote).filter(Vote.choice_id==self.choice_id, Vote.user_id==User.user_id).all()
         return voters
 
+    @classmethod
+    def reconcile_vote_counts(cls, post_id=None):
+        """rebuilds the maintained vote counts from the votes table, for all choices or only the choices of one post;
+        returns the number of choices updated"""
+        votes = db.select([db.func.count(Vote.vote_id)]).where(Vote.choice_id == cls.choice_id).as_scalar()
+        query = cls.query
+        if post_id:
+            query = query.filter(cls.post_id == post_id)
+        updated = query.update({cls.vote_count: votes}, synchronize_session=False)
+        db.session.commit()
+        return updated
+
 
 class Tag(db.Model):
     """ Tags table """
@@ -613,8 +1271,12 @@ class Tag(db.Model):
     tag_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     tag_name = db.Column(db.String(100),
                          nullable=False)  # TODO: Turn the data type into db.text, otherwise it needs cast
+    # the number of posts with the tag, kept up to date by TagPost.create and Post.delete_by_post_id
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
 
-    posts = db.relationship("Post", secondary="tagsposts", backref=db.backref("tags", order_by=tag_id))
+    # read only, the tagsposts rows are written through TagPost and deleted with Post.tagposts
+    posts = db.relationship("Post", secondary="tagsposts", viewonly=True,
+                            backref=db.backref("tags", order_by=tag_id, viewonly=True))
 
     def __repr__(self):
         return "<Tag tag_id=%s tag_name=%s>" % (self.tag_id, self.tag_name)
@@ -623,9 +1285,33 @@ class Tag(db.Model):
     def create(cls, tag_name):
         new_tag = cls(tag_name=tag_name)
         db.session.add(new_tag)
-        db.session.commit()
+        commit()
+        UnitOfWork.after_commit(lambda: tag_index.add(tag_name))  # only suggested once it is saved
         return new_tag
 
+    @classmethod
+    def resolve_tag_names(cls, tag_names):
+        """returns the ids of the tags with these names, in the same order and without duplicates, inserting the tags
+        that don't exist yet. The names are looked up with one IN query and the new tags inserted with one statement;
+        nothing is committed. The new tags are suggested once committed, so call it within a unit of work"""
+        tag_names = list(OrderedDict.fromkeys(name.strip() for name in tag_names if name.strip()))
+        if not tag_names:
+            return []
+
+        def lookup():
+            ids = {}
+            for chunk in chunks(tag_names, IN_CLAUSE_LIMIT):
+                ids.update(db.session.query(cls.tag_name, cls.tag_id).filter(cls.tag_name.in_(chunk)))
+            return ids
+
+        ids = lookup()
+        missing = [name for name in tag_names if name not in ids]
+        if missing:
+            db.session.execute(cls.__table__.insert(), [{'tag_name': name, 'post_count': 0} for name in missing])
+            ids = lookup()
+            UnitOfWork.after_commit(lambda: [tag_index.add(name) for name in missing])
+        return [ids[name] for name in tag_names]
+
     @classmethod
     def get_tags_by_post_id(cls, post_id):
         return cls.query.filter(cls.posts.any(post_id=post_id)).all()
@@ -639,25 +1325,51 @@ class Tag(db.Model):
         return cls.query.filter_by(tag_name=tag_name).first()
     @classmethod
     def sort_all_tags_by_popularity(cls):
-        all_tags = cls.get_all_tags()
-        count_dict = {}
-        for tag in all_tags:
-            count = len(tag.posts)
-            if count in count_dict:
-                count_dict[count].append(tag)
-            else:
-                count_dict[count] = [tag]
-        all_counts_sorted = sorted(count_dict.keys(), reverse=True)
-        sorted_tag_list = []
-        for count in all_counts_sorted:
-            sorted_tag_list.extend(count_dict[count])
-        return sorted_tag_list
+        return cls.query.order_by(cls.post_count.desc(), cls.tag_id).all()
 
     @classmethod
     def get_most_popular_tags(cls, n):
-        """the argument n decides how many tags you want"""
-        all_sorted_tags = cls.sort_all_tags_by_popularity()
-        return all_sorted_tags[:n]
+        """the argument n decides how many tags you want; the tags come from the cached leaderboard, as PopularTag
+        tuples, so this doesn't touch the database more than once every POPULAR_TAGS_TTL seconds"""
+        if n > POPULAR_TAGS_SIZE:
+            return [PopularTag(tag.tag_id, tag.tag_name, tag.post_count)
+                    for tag in cls.query.order_by(cls.post_count.desc(), cls.tag_id).limit(n)]
+        leaderboard = popular_tags_cache.get('leaderboard')
+        if leaderboard is None:
+            leaderboard = [PopularTag(*row) for row in db.session.query(cls.tag_id, cls.tag_name, cls.post_count)
+                           .order_by(cls.post_count.desc(), cls.tag_id).limit(POPULAR_TAGS_SIZE)]
+            popular_tags_cache.set('leaderboard', leaderboard)
+        return leaderboard[:n]
+
+    @classmethod
+    def suggest(cls, prefix, limit=10):
+        """the names of up to limit tags starting with prefix, case insensitively, the most used first; an empty
+        prefix gives the most popular tags"""
+        if not prefix:
+            return [tag.tag_name for tag in cls.get_most_popular_tags(limit)]
+        if tag_index.stale:
+            tag_index.load(db.session.query(cls.tag_name, cls.post_count))
+        return tag_index.search(prefix, limit)
+
+    @classmethod
+    def update_post_counts(cls, tag_ids, change):
+        """adds change to the post counts of the tags, in one statement"""
+        if tag_ids:
+            cls.query.filter(cls.tag_id.in_(tag_ids))\
+                .update({cls.post_count: cls.post_count + change}, synchronize_session=False)
+
+    @classmethod
+    def reconcile_post_counts(cls):
+        """rebuilds the maintained post counts from the tagsposts table; returns the number of tags updated"""
+        posts = db.select([db.func.count(TagPost.tagpost_id)]).where(TagPost.tag_id == cls.tag_id).as_scalar()
+        updated = cls.query.update({cls.post_count: posts}, synchronize_session=False)
+        db.session.commit()
+        popular_tags_cache.clear()
+        return updated
+
+
+# a row of the tag leaderboard, detached from the session so it can be cached
+PopularTag = namedtuple('PopularTag', ['tag_id', 'tag_name', 'post_count'])
 
 
 class TagPost(db.Model):
@@ -671,14 +1383,332 @@ class TagPost(db.Model):
     def create(cls, post_id, tag_id):
         new_tagpost = cls(post_id=post_id, tag_id=tag_id)
         db.session.add(new_tagpost)
-        db.session.commit()
+        Tag.update_post_counts([tag_id], 1)
+        search_index().add(post_id, [(Tag.query.get(tag_id).tag_name, 'A')])
+        commit()
         return new_tagpost
 
+    @classmethod
+    def create_many(cls, post_id, tag_ids):
+        """tags a post with all the tags at once, without committing"""
+        if tag_ids:
+            db.session.execute(cls.__table__.insert(), [{'post_id': post_id, 'tag_id': tag_id} for tag_id in tag_ids])
+            Tag.update_post_counts(tag_ids, 1)
+
+
+
+class Media(db.Model):
+    """An image stored in s3 under the md5 of its content, see content_md5(). Posts and choices with the same image
+    share the object: it is only stored for the first of them, and ref_count counts the posts and choices referring
+    to it, so the object is deleted once the last of them is. Images uploaded before this table existed have no row
+    here."""
+
+    __tablename__ = "media"
+    key_name = db.Column(db.String(250), primary_key=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    state = db.Column(db.String(10), nullable=False, default=MEDIA_PENDING)
+    variants = db.Column(db.Boolean, nullable=False, default=False)  # whether the variants are stored too
+
+    def __repr__(self):
+        return "<Media key_name=%s ref_count=%s state=%s>" % (self.key_name, self.ref_count, self.state)
+
+    @classmethod
+    def acquire(cls, key_name):
+        """adds a reference to the image stored under key_name, without committing; returns the media (its state and
+        variants) and whether the image has to be uploaded, which it has unless it is stored already or being
+        uploaded. The row is inserted or its count incremented with one upsert, so two posts of the same new image
+        at once both get their reference"""
+        media = db.session.execute(MEDIA_UPSERT, {'key_name': key_name, 'state': MEDIA_PENDING}).first()
+        if media.ref_count == 1:  # a new row, the rows of images still referred to never count less than one
+            # the object of an image deleted earlier may still be waiting to be deleted from s3
+            PendingDeletion.query.filter(PendingDeletion.key_name.in_(
+                [key_name] + [variant_key(key_name, variant) for variant in IMAGE_VARIANTS]))\
+                .delete(synchronize_session=False)
+            return media, True
+        if media.state == MEDIA_FAILED:  # uploaded again by the one post that moves it back to pending
+            retried = cls.query.filter(cls.key_name == key_name, cls.state == MEDIA_FAILED)\
+                .update({cls.state: MEDIA_PENDING}, synchronize_session=False)
+            if retried:
+                return MediaState(MEDIA_PENDING, media.variants), True
+        return media, False
+
+    @classmethod
+    def release(cls, key_names):
+        """removes a reference to each of the images, without committing; returns the keys of the objects no post or
+        choice refers to any more, which are to be deleted from s3, including the ones without a row here"""
+        counts = Counter(key_names)
+        for key_name, count in counts.items():
+            cls.query.filter(cls.key_name == key_name)\
+                .update({cls.ref_count: cls.ref_count - count}, synchronize_session=False)
+
+        tracked = set()
+        unreferenced = []
+        for chunk in chunks(list(counts), IN_CLAUSE_LIMIT):
+            for key_name, ref_count in db.session.query(cls.key_name, cls.ref_count).filter(cls.key_name.in_(chunk)):
+                tracked.add(key_name)
+                if ref_count <= 0:
+                    unreferenced.append(key_name)
+        for chunk in chunks(unreferenced, IN_CLAUSE_LIMIT):
+            cls.query.filter(cls.key_name.in_(chunk)).delete(synchronize_session=False)
+        return unreferenced + [key_name for key_name in counts if key_name not in tracked]
+
+
+# the statement behind Media.acquire(): a new image gets a row referred to once, an image stored already one more
+# reference
+MEDIA_UPSERT = db.text("""
+    INSERT INTO media (key_name, ref_count, state, variants) VALUES (:key_name, 1, :state, :variants)
+    ON CONFLICT (key_name) DO UPDATE SET ref_count = media.ref_count + 1
+    RETURNING ref_count, state, variants""").bindparams(db.bindparam('variants', False, type_=db.Boolean))\
+    .columns(ref_count=db.Integer, state=db.String, variants=db.Boolean)
+# what acquire() tells of an image
+MediaState = namedtuple('MediaState', ['state', 'variants'])
+
+
+class PendingDeletion(db.Model):
+    """An object in s3 waiting to be deleted. The rows are written in the same transaction as the delete of the post
+    the objects belong to and only removed once s3 confirms their delete, so a delete is retried until it goes
+    through even if s3 is down or the process dies in between"""
+
+    __tablename__ = "pending_deletions"
+    key_name = db.Column(db.String(250), primary_key=True)
+    queued_at = db.Column(db.TIMESTAMP, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def queue(cls, key_names):
+        """queues objects for deletion, without committing"""
+        key_names = set(key_names)
+        for chunk in chunks(list(key_names), IN_CLAUSE_LIMIT):
+            key_names.difference_update(key_name for (key_name,) in
+                                        db.session.query(cls.key_name).filter(cls.key_name.in_(chunk)))
+        if key_names:
+            now = datetime.utcnow()
+            db.session.execute(cls.__table__.insert(),
+                               [{'key_name': key_name, 'queued_at': now, 'attempts': 0} for key_name in key_names])
+
+    @classmethod
+    def flush(cls, batch_size=S3_DELETE_BATCH_SIZE):
+        """deletes all the queued objects from s3, batch_size keys per request; the keys s3 couldn't delete stay
+        queued for the next flush. Returns the number of objects deleted"""
+        deleted = 0
+        last_key_name = None
+        while True:
+            query = db.session.query(cls.key_name).order_by(cls.key_name)
+            if last_key_name is not None:
+                query = query.filter(cls.key_name > last_key_name)
+            key_names = [key_name for (key_name,) in query.limit(batch_size)]
+            if not key_names:
+                return deleted
+            last_key_name = key_names[-1]
+
+            try:
+                result = bucket.delete_keys(key_names, quiet=True)
+                failed = set(error.key for error in result.errors)
+            except Exception:
+                cls.query.filter(cls.key_name.in_(key_names))\
+                    .update({cls.attempts: cls.attempts + 1}, synchronize_session=False)
+                db.session.commit()
+                raise
+
+            done = [key_name for key_name in key_names if key_name not in failed]
+            for chunk in chunks(done, IN_CLAUSE_LIMIT):
+                cls.query.filter(cls.key_name.in_(chunk)).delete(synchronize_session=False)
+            if failed:
+                cls.query.filter(cls.key_name.in_(failed))\
+                    .update({cls.attempts: cls.attempts + 1}, synchronize_session=False)
+            db.session.commit()
+            deleted += len(done)
+
+
+# flushes the pending deletions in the background once server.py starts it, and every DELETION_FLUSH_INTERVAL
+# seconds to retry the ones that failed
+deletion_flusher = Flusher(PendingDeletion.flush, interval=int(os.environ.get('DELETION_FLUSH_INTERVAL', 60)))
+
+
+class SearchTerm(db.Model):
+    """A word of a post in the inverted index the posts are searched with where postgresql's full text search isn't
+    there, see search.py; weight adds up the weights of the fields the word occurs in, once per occurrence"""
+
+    __tablename__ = "search_terms"
+
+    term = db.Column(db.String(64), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.post_id'), primary_key=True, index=True)
+    weight = db.Column(db.Float, nullable=False)
+
+
+term_index = TermIndex(db, SearchTerm.__table__)
+document_index = DocumentIndex(db)
+
+
+def search_index():
+    """the index the posts are searched with: the tsvectors of postgresql, the table of terms elsewhere"""
+    return document_index if db.engine.dialect.name == 'postgresql' else term_index
+
+
+##############################################################################
+# Database triggers
+
+# The vote counts on the choices and the versions of the posts are maintained by the database itself, so every way a
+# vote is written (Vote.create, Vote.update_vote, or the delete cascades of users and choices) updates them in the
+# same transaction.
+VOTE_TRIGGERS = {
+    'sqlite': [
+        "DROP TRIGGER IF EXISTS votes_count_insert",
+        "DROP TRIGGER IF EXISTS votes_count_update",
+        "DROP TRIGGER IF EXISTS votes_count_delete",
+        """CREATE TRIGGER votes_count_insert AFTER INSERT ON votes
+        BEGIN
+            UPDATE choices SET vote_count = vote_count + 1 WHERE choice_id = NEW.choice_id;
+            UPDATE posts SET version = version + 1
+            WHERE post_id = (SELECT post_id FROM choices WHERE choice_id = NEW.choice_id);
+        END""",
+        """CREATE TRIGGER votes_count_update AFTER UPDATE OF choice_id ON votes
+        WHEN OLD.choice_id != NEW.choice_id
+        BEGIN
+            UPDATE choices SET vote_count = vote_count - 1 WHERE choice_id = OLD.choice_id;
+            UPDATE choices SET vote_count = vote_count + 1 WHERE choice_id = NEW.choice_id;
+            UPDATE posts SET version = version + 1
+            WHERE post_id = (SELECT post_id FROM choices WHERE choice_id = NEW.choice_id);
+        END""",
+        """CREATE TRIGGER votes_count_delete AFTER DELETE ON votes
+        BEGIN
+            UPDATE choices SET vote_count = vote_count - 1 WHERE choice_id = OLD.choice_id;
+            UPDATE posts SET version = version + 1
+            WHERE post_id = (SELECT post_id FROM choices WHERE choice_id = OLD.choice_id);
+        END""",
+    ],
+    'postgresql': [
+        """CREATE OR REPLACE FUNCTION maintain_vote_counts() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.choice_id = NEW.choice_id THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+                UPDATE choices SET vote_count = vote_count - 1 WHERE choice_id = OLD.choice_id;
+            END IF;
+            IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+                UPDATE choices SET vote_count = vote_count + 1 WHERE choice_id = NEW.choice_id;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                UPDATE posts SET version = version + 1
+                WHERE post_id = (SELECT post_id FROM choices WHERE choice_id = OLD.choice_id);
+            ELSE
+                UPDATE posts SET version = version + 1
+                WHERE post_id = (SELECT post_id FROM choices WHERE choice_id = NEW.choice_id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS votes_count ON votes",
+        """CREATE TRIGGER votes_count AFTER INSERT OR DELETE OR UPDATE OF choice_id ON votes
+        FOR EACH ROW EXECUTE PROCEDURE maintain_vote_counts()""",
+    ],
+}
+
+for dialect_name, statements in VOTE_TRIGGERS.items():
+    for statement in statements:
+        event.listen(Vote.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect_name))
+
+
+def install_triggers():
+    """(re)creates the triggers on a database whose tables were created before the triggers existed"""
+    for statement in VOTE_TRIGGERS.get(db.engine.dialect.name, []):
+        db.session.execute(statement)
+    db.session.commit()
+
+
+# the table of the tsvectors the posts are searched with on postgresql, which is dropped before the posts it refers to
+for statement in DocumentIndex.DDL:
+    event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+event.listen(Post.__table__, 'before_drop', DDL(DocumentIndex.DROP_DDL).execute_if(dialect='postgresql'))
+
+
+def install_search():
+    """creates the search index on a database whose tables were created before it existed"""
+    SearchTerm.__table__.create(db.engine, checkfirst=True)
+    if db.engine.dialect.name == 'postgresql':
+        for statement in DocumentIndex.DDL:
+            db.session.execute(statement)
+    db.session.commit()
 
 
 ##############################################################################
 # Helper functions
 
+def media_uploaded(key_name, succeeded, variants=()):
+    """called by the upload pool when the upload of the image of a post or choice is over"""
+    state = MEDIA_READY if succeeded else MEDIA_FAILED
+    has_variants = set(variants) == set(IMAGE_VARIANTS)
+    for model in (Post, Choice):
+        model.query.filter(model.file_name == key_name)\
+            .update({model.media_state: state, model.media_variants: has_variants}, synchronize_session=False)
+    Media.query.filter(Media.key_name == key_name)\
+        .update({Media.state: state, Media.variants: has_variants}, synchronize_session=False)
+    db.session.commit()
+
+
+def upload_key_prefix(user_id):
+    """the prefix of the keys the user uploads files to"""
+    return "%s/%s/" % (UPLOAD_PREFIX, user_id)
+
+
+def sign_upload(user_id, filename):
+    """the form with which the user uploads the file filename straight to s3, under a new key of theirs: a dict of
+    the key, the action url and the fields of the form. Raises InvalidUpload if files of this type aren't allowed"""
+    if not allowed_file(filename):
+        raise InvalidUpload('the file type you uploaded is not valid')
+    key_name = upload_key_prefix(user_id) + uuid.uuid4().hex
+    content_type = mimetypes.guess_type(filename)[0]
+    form = upload_form(conn, bucket.name, key_name, content_type, MAX_UPLOAD_SIZE, expires_in=UPLOAD_EXPIRES_IN)
+    form['key'] = key_name
+    return form
+
+
+def verify_upload(user_id, key_name):
+    """the object the user uploaded to key_name, checked to be theirs, not too large and of a type allowed; raises
+    InvalidUpload otherwise"""
+    if not key_name.startswith(upload_key_prefix(user_id)):
+        raise InvalidUpload('the file you uploaded is not valid')
+    upload = bucket.get_key(key_name)
+    if upload is None:
+        raise InvalidUpload('your file could not be found, please upload it again')
+    if upload.size > MAX_UPLOAD_SIZE:
+        raise UploadTooLarge('Your files can be at most %d MB each' % (MAX_UPLOAD_SIZE / (1024 * 1024)))
+    if upload.content_type not in ALLOWED_CONTENT_TYPES:
+        raise InvalidUpload('the file type you uploaded is not valid')
+    return upload
+
+
+def media_url(item, variant=None):
+    """the url of the image of a post or choice, of its variant if it has one; a template global"""
+    if variant and item.media_variants:
+        return S3_URL + variant_key(item.file_name, variant)
+    return S3_URL + item.file_name
+
+
+def backfill_variants(batch_size=100):
+    """stores the variants of the images uploaded before they existed; returns the number of images done"""
+    done = 0
+    for model, id_column in ((Post, Post.post_id), (Choice, Choice.choice_id)):
+        last_id = 0
+        while True:
+            items = model.query.filter(model.file_name != None, model.media_variants == False,
+                                       db.or_(model.media_state == None, model.media_state == MEDIA_READY),
+                                       id_column > last_id).order_by(id_column).limit(batch_size).all()
+            if not items:
+                break
+            last_id = getattr(items[-1], id_column.key)
+            for item in items:
+                variants = upload_pool.store_variants(item.file_name)
+                if set(variants) == set(IMAGE_VARIANTS):
+                    item.media_variants = True
+                    Media.query.filter(Media.key_name == item.file_name)\
+                        .update({Media.variants: True}, synchronize_session=False)
+                    done += 1
+            db.session.commit()
+    return done
+
+
 def connect_to_db(app):
     """Connect the database to our Flask app."""
 
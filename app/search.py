@@ -0,0 +1,144 @@
+"""Full-text search over the posts: their description, tags, choices and comments.
+
+A post is indexed as a list of fields, (text, weight) pairs where the weight is one of the letters of postgresql's
+setweight(): 'A' for the description and the tags, 'B' for the choices and 'C' for the comments, so a match in the
+question ranks above one in a comment. On postgresql the posts are indexed in a tsvector column with a GIN index
+(DocumentIndex); elsewhere, e.g. on the sqlite database of the tests, in a table of terms (TermIndex). Both are
+updated in place as posts and comments are written, and match the posts containing every word searched for.
+"""
+
+from collections import Counter
+import math
+import re
+
+# the weights of the fields, those ts_rank() gives the letters by default
+WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2, 'D': 0.1}
+MAX_TERM_LENGTH = 64
+STOP_WORDS = frozenset("""a about an and are as at be but by for from has have how i if in is it of on or so that the
+    their there this to was what when which who why will with would you your""".split())
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """the terms of a text: its words lowercased, without the stop words and the single letters"""
+    return [word[:MAX_TERM_LENGTH] for word in WORD.findall((text or u'').lower())
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+def term_weights(fields):
+    """the weight of every term of the fields, the weights of its occurrences added up"""
+    weights = Counter()
+    for text, weight in fields:
+        for term in tokenize(text):
+            weights[term] += WEIGHTS[weight]
+    return weights
+
+
+class TermIndex(object):
+    """An inverted index kept in a table of (term, post_id, weight) rows, for the databases without a full text search
+    of their own. The posts are ranked by the weights of the terms searched for, each scaled by how rare the term is
+    among the posts (its inverse document frequency). Words are matched whole, without stemming."""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self._upsert = db.text("""
+            INSERT INTO %(table)s (term, post_id, weight) VALUES (:term, :post_id, :weight)
+            ON CONFLICT (term, post_id) DO UPDATE SET weight = %(table)s.weight + excluded.weight"""
+                               % {'table': table.name})
+
+    def add(self, post_id, fields):
+        """adds the fields to what is indexed of the post"""
+        rows = [{'term': term, 'post_id': post_id, 'weight': weight}
+                for term, weight in term_weights(fields).items()]
+        if rows:
+            self.db.session.execute(self._upsert, rows)
+
+    def replace(self, post_id, fields):
+        """indexes the post with these fields only"""
+        self.drop(post_id)
+        self.add(post_id, fields)
+
+    def drop(self, post_id):
+        self.db.session.execute(self.table.delete().where(self.table.c.post_id == post_id))
+
+    def search(self, text, offset=0, limit=20):
+        """the ids of the best matching posts, best first, and the number of posts matching"""
+        terms = sorted(set(tokenize(text)))
+        if not terms:
+            return [], 0
+        table, session = self.table, self.db.session
+        frequencies = dict(session.execute(self.db.select([table.c.term, self.db.func.count()])
+                                           .where(table.c.term.in_(terms)).group_by(table.c.term)).fetchall())
+        if len(frequencies) < len(terms):  # a word no post has
+            return [], 0
+        posts = session.execute(self.db.select([self.db.func.count(self.db.distinct(table.c.post_id))])).scalar()
+
+        idf = self.db.case([(table.c.term == term, math.log(1.0 + float(posts) / frequencies[term]))
+                            for term in terms])
+        score = self.db.func.sum(table.c.weight * idf).label('score')
+        matches = self.db.select([table.c.post_id, score]).where(table.c.term.in_(terms))\
+            .group_by(table.c.post_id).having(self.db.func.count() == len(terms))
+        total = session.execute(self.db.select([self.db.func.count()]).select_from(matches.alias())).scalar()
+        rows = session.execute(matches.order_by(score.desc(), table.c.post_id.desc())
+                               .limit(limit).offset(offset)).fetchall()
+        return [post_id for post_id, score in rows], total
+
+
+class DocumentIndex(object):
+    """The posts indexed in a tsvector column of the search_documents table, with a GIN index, for postgresql: the
+    words are stemmed with the text search configuration given and the posts ranked with ts_rank(). The table is
+    created by the DDL statements below."""
+
+    DDL = [
+        """CREATE TABLE IF NOT EXISTS search_documents (
+            post_id INTEGER PRIMARY KEY REFERENCES posts (post_id) ON DELETE CASCADE,
+            document TSVECTOR NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS ix_search_documents_document ON search_documents USING GIN (document)",
+    ]
+    DROP_DDL = "DROP TABLE IF EXISTS search_documents"
+
+    def __init__(self, db, config='english'):
+        self.db = db
+        self.config = config
+
+    def _document(self, fields, params):
+        """the tsvector of the fields, as sql taking its values from params"""
+        vectors = []
+        for number, (text, weight) in enumerate(fields):
+            if weight not in WEIGHTS:
+                raise ValueError("unknown weight %r" % weight)
+            params['text%d' % number] = text or u''
+            vectors.append("setweight(to_tsvector(:config, :text%d), '%s')" % (number, weight))
+        return " || ".join(vectors) or "''::tsvector"
+
+    def _write(self, post_id, fields, on_conflict):
+        params = {'post_id': post_id, 'config': self.config}
+        self.db.session.execute(self.db.text(
+            "INSERT INTO search_documents (post_id, document) VALUES (:post_id, %s) "
+            "ON CONFLICT (post_id) DO UPDATE SET document = %s" % (self._document(fields, params), on_conflict)),
+            params)
+
+    def add(self, post_id, fields):
+        """adds the fields to what is indexed of the post"""
+        self._write(post_id, fields, "search_documents.document || excluded.document")
+
+    def replace(self, post_id, fields):
+        """indexes the post with these fields only"""
+        self._write(post_id, fields, "excluded.document")
+
+    def drop(self, post_id):
+        self.db.session.execute(self.db.text("DELETE FROM search_documents WHERE post_id = :post_id"),
+                                {'post_id': post_id})
+
+    def search(self, text, offset=0, limit=20):
+        """the ids of the best matching posts, best first, and the number of posts matching"""
+        rows = self.db.session.execute(self.db.text("""
+            SELECT post_id, count(*) OVER () AS total
+            FROM search_documents, plainto_tsquery(:config, :text) query
+            WHERE document @@ query
+            ORDER BY ts_rank(document, query) DESC, post_id DESC
+            LIMIT :limit OFFSET :offset"""),
+            {'config': self.config, 'text': text, 'limit': limit, 'offset': offset}).fetchall()
+        return [post_id for post_id, total in rows], rows[0][1] if rows else 0
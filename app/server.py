@@ -2,9 +2,12 @@
 # from facebook import get_user_from_cookie, GraphAPI
 from jinja2 import StrictUndefined
 from flask_debugtoolbar import DebugToolbarExtension
-from flask import Flask, render_template, redirect, request, flash, session, url_for, g
-from models import User, Comment, Post, Vote, Choice, Tag, Follow, connect_to_db
-from boto.s3.connection import S3Connection
+from flask import Flask, render_template, redirect, request, flash, session, url_for, g, Response, abort
+from models import User, Comment, Post, Vote, Choice, Tag, Follow, connect_to_db, upload_pool, \
+    deletion_flusher, media_url, sign_upload, InvalidUpload, UnitOfWork, vote_buffer, start_vote_buffer, \
+    VOTE_BUFFER_SIZE, live_results
+from storage import connect_s3
+from live import event_stream
 import os
 from flask import jsonify
 import facebook
@@ -22,7 +25,7 @@ app.secret_key = os.environ.get("FLASK_SECRET_KEY", "ABC")
 app.jinja_env.undefined = StrictUndefined
 
 # setup for s3
-conn = S3Connection(os.environ["AWS_ACCESS_KEY"], os.environ["AWS_SECRET_KEY"])
+conn = connect_s3()
 bucket = conn.get_bucket(os.environ['AWS_BUCKET'])
 
 # Facebook details
@@ -30,6 +33,9 @@ FB_APP_ID = os.environ["FB_APP_ID"]
 FB_APP_NAME = os.environ["FB_APP_NAME"]
 FB_APP_SECRET = os.environ["FB_APP_SECRET"]
 
+# how many of the most popular tags the home page features
+FEATURED_TAGS = 20
+
 
 
 #######################################################################################################
@@ -43,6 +49,7 @@ def datetimefilter(value, format='%Y/%m/%d %H:%M'):
 
 
 app.jinja_env.filters['datetimefilter'] = datetimefilter
+app.jinja_env.globals['media_url'] = media_url
 
 #######################################################################################################
 # functions that handles login and logout
@@ -51,13 +58,12 @@ app.jinja_env.filters['datetimefilter'] = datetimefilter
 def login():
     """Homepage with login"""
     # Get all of the authenticated user's friends
-    tag_names = [str(tag.tag_name) for tag in Tag.get_all_tags()]
-    session['tag_names'] = tag_names
     top_6_tags = Tag.get_most_popular_tags(6)
     return render_template("login.html", top_6_tags=top_6_tags)
 
 
 @app.route('/facebook-login-portal', methods=['POST'])
+@UnitOfWork()  # the user, their profile and the friends they follow are committed together
 def facebook_login():
     """Handles the login from the facebook login button)"""
     user_id = str(request.form.get('user_id'))
@@ -94,16 +100,12 @@ def facebook_login():
         print "Hi, you're already a user."
         session["loggedin"] = user.user_id
         session["current_access_token"] = current_access_token
+        remember_profile(user)
         flash("Login successful!")
 
         if friend_ids:
-            for friend_id in friend_ids:
-                friend = User.get_user_by_id(friend_id)
-                print "friend is ", friend
-                # check to see if the friend is also an user in the app
-                if friend:
-                    if not user.is_following(friend):
-                        user.follow(friend)
+            # follow the friends who are also users in the app, all at once
+            user.follow_friends(friend_ids)
 
         flash('Thanks for logging into Opinionated')
         return redirect('/home')  # the return is not needed because this is a json post, do redirect in json
@@ -116,10 +118,17 @@ def facebook_login():
                                profile_pic=profile_pic)
         session["loggedin"] = new_user.user_id
         session["current_access_token"] = current_access_token
+        remember_profile(new_user)
         flash("Thanks for logging into Opinionated")
         return redirect("/home")
 
 
+def remember_profile(user):
+    """keeps the name and picture of the logged in user in the session, for the pages that show them"""
+    session["user_name"] = user.user_name
+    session["profile_pic"] = user.profile_pic
+
+
 def parsing_friends_data(friends):
     """parsing the data received from graph api call to return only the ids of the friends"""
     friend_data = friends.get('data', None)
@@ -135,6 +144,8 @@ def logout_user():
     session.pop('loggedin', None)
     flash("You have logged out")
     session.pop("current_access_token", None)
+    session.pop("user_name", None)
+    session.pop("profile_pic", None)
     flash("You have logged out of Facebook")
     return redirect(url_for('login'))
 
@@ -148,7 +159,7 @@ def show_all_posts():
     show_followed = False
     # get the variable "show-all" from the template to determine whether to show all posts or followed ones
     show_what = request.args.get('show-all')
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     print show_what, "this is show_what"
     if show_what == "false":
         show_followed = True
@@ -156,14 +167,12 @@ def show_all_posts():
     if show_followed:
         viewer_id = session.get('loggedin', None)
         viewer = User.get_user_by_id(viewer_id)
-        posts_all = viewer.followed_posts()
-        pagination = viewer.followed_posts_pagination(page)
+        pagination = viewer.followed_posts_page(cursor)
+        session["feed"] = "followed:%d" % viewer_id  # the feed the previous/next links of a post walk through
     else:
-        posts_all = Post.get_all_posts()
-        pagination = Post.get_all_posts_pagination(page)
-    if posts_all:
-        session["post_ids"] = [post.post_id for post in posts_all]
-    tags = Tag.sort_all_tags_by_popularity()
+        pagination = Post.get_all_posts_page(cursor)
+        session["feed"] = "all"
+    tags = Tag.get_most_popular_tags(FEATURED_TAGS)
 
     posts = pagination.items  # the records in the current page
 
@@ -179,32 +188,41 @@ def show_post_detail(post_id):
     viewer_id = session.get('loggedin', None)
     if_voted = None
     if viewer_id:
-        if_voted = post.check_choice_on_post_by_user_id(viewer_id)
-
-    vote_dict, total_votes, chart_dict = post.count_votes()
-    bar_chart_gender = post.bar_chart_gender()
-    geochart = post.count_votes_by_location()
-    bar_chart_age = post.count_votes_by_age()
+        if_voted = post.voted_choice(viewer_id)
 
-    comments = Comment.get_comments_by_post_id(post_id)
+    comments = Comment.get_comments_page(post_id, request.args.get('cursor'))
     tag_names = [tag.tag_name for tag in Tag.get_tags_by_post_id(post_id)]
-    post_ids = session.get("post_ids", None)
     state = post.state  # this gives a choice_id or Null, for displaying the decision the author has made
     decision = None
     if state:
         decision = Choice.get_choice_by_id(state)
 
     if if_voted:
-        return render_template('post_details.html', post=post, choices=choices, vote_dict=vote_dict,
-                               comments=comments, total_votes=total_votes, tag_names=tag_names,
-                               post_ids=post_ids, chart_dict=chart_dict, decision=decision,
-                               bar_chart_gender=bar_chart_gender,
-                               geochart=geochart, bar_chart_age=bar_chart_age)
+        # served from the results cache until someone votes on the post again
+        results = post.results_for(User.get_user_by_id(viewer_id))
+        return render_template('post_details.html', post=post, choices=choices, vote_dict=results['vote_dict'],
+                               comments=comments, total_votes=results['total_votes'], tag_names=tag_names,
+                               chart_dict=results['chart_dict'], decision=decision,
+                               bar_chart_gender=results['bar_chart_gender'],
+                               geochart=results['geochart'], bar_chart_age=results['bar_chart_age'])
     else:
-        return render_template('post_details.html', post=post, choices=choices, comments=comments, post_ids=post_ids,
+        total_votes = sum(choice.vote_count for choice in choices)
+        return render_template('post_details.html', post=post, choices=choices, comments=comments,
                                tag_names=tag_names, total_votes=total_votes)
 
 
+@app.route('/home/post/<int:post_id>/previous', defaults={'direction': 'prev'})
+@app.route('/home/post/<int:post_id>/next', defaults={'direction': 'next'})
+def navigate_posts(post_id, direction):
+    """go to the post before or after this one in the feed the user came from"""
+    post = Post.query.get_or_404(post_id)
+    neighbour = post.get_neighbour_in_feed(session.get("feed", "all"), direction)
+    if neighbour is None:
+        flash("There are no more posts this way")
+        return redirect(url_for('show_post_detail', post_id=post_id))
+    return redirect(url_for('show_post_detail', post_id=neighbour.post_id))
+
+
 @app.route('/home/post/<int:post_id>/share', methods=['POST'])
 @login_required
 def share_post_fb(post_id):
@@ -237,7 +255,7 @@ def update_decision(post_id):
     if choice_id != "0":
         choice = Choice.get_choice_by_id(choice_id)
         decision_text = "The user has decided to go with: " + choice.choice_text
-        decision_file = choice.file_name
+        decision_file = media_url(choice, 'medium') if choice.file_name else ""
     else:
         decision_text = "The author has made the decision but he/she likes to keep it secret"
         decision_file = ""
@@ -254,7 +272,7 @@ def update_decision(post_id):
 def user_profile(user_id):
     """this is the page that will show users' all posts, and all things they have voted on"""
     posts = Post.get_posts_by_author_id(user_id)
-    session["post_ids"] = [post.post_id for post in posts]
+    session["feed"] = "author:%s" % user_id
     user = User.get_user_by_id(user_id)
 
     viewer_id = session.get('loggedin')
@@ -286,6 +304,7 @@ def edit_profile_process():
     profile_pic = request.form.get('profile_pic')
     user.update_user_info(user_name=user_name, location=location, gender=gender, age_range=age_range,
                           about_me=about_me, profile_pic=profile_pic)
+    remember_profile(user)
     flash("Your information has been updated")
 
     return redirect(url_for('user_profile', user_id=user_id))
@@ -329,9 +348,10 @@ def followers(user_id):
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('show_all_posts'))
-    followers = user.get_all_followers()
+    page = request.args.get('page', 1, type=int)
+    pagination = user.get_followers_page(page)
 
-    return render_template('followers.html', followers=followers, user=user)
+    return render_template('followers.html', followers=pagination.items, pagination=pagination, user=user)
 
 
 @app.route('/home/followeds/<int:user_id>')
@@ -341,9 +361,10 @@ def followeds(user_id):
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('show_all_posts'))
-    followeds = user.get_all_followeds()
+    page = request.args.get('page', 1, type=int)
+    pagination = user.get_followeds_page(page)
 
-    return render_template('followeds.html', followeds=followeds, user=user)
+    return render_template('followeds.html', followeds=pagination.items, pagination=pagination, user=user)
 
 
 #######################################################################################################
@@ -356,35 +377,38 @@ def process_vote(post_id):
     """this is the function that process users' votes, so it updates the database and refresh the post-details
     page to show the updated votes and vote allocation"""
     if session.get('loggedin', None):
-        choice_id = request.form.get("choice_id")
+        choice_id = request.form.get("choice_id", type=int)
         user_id = session['loggedin']
 
         post = Post.get_post_by_id(post_id)
-        previous_vote = post.check_choice_on_post_by_user_id(user_id)
-
-        if previous_vote:  # if there is a previous vote, compare to the new vote see if they pointed to the same choice, update vote
-            if previous_vote != choice_id:
-                vote_id = Vote.get_vote_by_post_and_user_id(post.post_id, user_id)
-                Vote.update_vote(vote_id, choice_id)
+        voter = User.get_user_by_id(user_id)
+        if vote_buffer.started:
+            Vote.cast_later(user_id, post_id, choice_id)  # written with the next bulk flush
         else:
-            Vote.create(user_id=user_id, choice_id=choice_id)  # if it's first time vote, create a new vote
-
-        vote_dict, total_votes, chart_dict = post.count_votes()
+            version = post.version  # the results cached for this version can be patched with this vote
+            written, previous_vote = Vote.cast(user_id, post_id, choice_id)
+            if written:
+                post.apply_vote_to_results(voter, previous_vote, choice_id, version)
 
-        bar_chart_gender = post.bar_chart_gender()
-        geo_chart_location = post.count_votes_by_location()
-        bar_chart_age = post.count_votes_by_age()
-        total_votes_percent = {}
-        for vote in vote_dict:
-            total_votes_percent[vote] = float(vote_dict[vote]) / total_votes
-
-        return json.dumps(
-            [vote_dict, total_votes_percent, total_votes, chart_dict, bar_chart_gender, geo_chart_location,
-             bar_chart_age])
+        live_results.notify()  # the pages showing the post get the new results without waiting for the next poll
+        return json.dumps(Post.results_payload(post.results_for(voter)))
     else:
         return json.dumps("undefined")
 
 
+@app.route('/home/post/<int:post_id>/results/stream')
+def stream_results(post_id):
+    """pushes the results of the post to the page showing it as server-sent events, whenever votes change them;
+    the page passes the version of the post it was rendered with, the browser the id of the last event on reconnects"""
+    if Post.get_post_by_id(post_id) is None:
+        abort(404)
+    version = request.headers.get('Last-Event-ID') or request.args.get('version')
+    subscription = live_results.subscribe(post_id, int(version) if version and version.isdigit() else None,
+                                          app=app)
+    return Response(event_stream(live_results, subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 #######################################################################################################
 # functions that handles posting a question
 
@@ -392,35 +416,49 @@ def process_vote(post_id):
 @login_required
 def post_question():
     """This is the render the page that users can edit their questions/posts """
-    tag_names = [str(tag.tag_name) for tag in Tag.get_all_tags()]
-    return render_template("post_question.html", tag_names=tag_names)
+    return render_template("post_question.html")
 
 
 @app.route('/home/post/process', methods=['GET', 'POST'])
 @login_required
+@UnitOfWork()
 def process_question():
     """Process the questions that user added, and updated the database"""
     description = request.form.get('description')
-    file_name = request.files.get('fileupload_question')
+    # the files were uploaded straight to s3 already, the form only carries their keys
+    file_name = request.form.get('upload_question')
     text_option1 = request.form.get('option1')
     text_option2 = request.form.get('option2')
-    fileupload1 = request.files.get('fileupload1')
-    fileupload2 = request.files.get('fileupload2')
-    print fileupload1, "this is file uploaded"
-    print type(fileupload1), "this is the type"
+    upload1 = request.form.get('upload1')
+    upload2 = request.form.get('upload2')
     author_id = session['loggedin']
     tags = request.form.get('hidden_tags')
     print tags, "this is the tag passed in"
 
-    choice_data = [(text_option1, fileupload1), (text_option2, fileupload2)]
+    choice_data = [(text_option1, upload1), (text_option2, upload2)]
 
-    Post.create(author_id=author_id, description=description, tag_list=tags, choice_data=choice_data,
-                file_name=file_name)
+    try:
+        Post.create(author_id=author_id, description=description, tag_list=tags, choice_data=choice_data,
+                    file_name=file_name)
+    except InvalidUpload as e:
+        flash(str(e))
+        return redirect(url_for('post_question'))
     flash('Your question has been posted')
 
     return redirect(url_for('user_profile', user_id=author_id))
 
 
+@app.route('/home/uploads/sign', methods=['POST'])
+@login_required
+def sign_file_upload():
+    """the signed form with which the browser uploads a file of the post form straight to s3"""
+    try:
+        form = sign_upload(session['loggedin'], request.form.get('filename', ''))
+    except InvalidUpload as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(form)
+
+
 #######################################################################################################
 # functions that handles deleting an existing post
 
@@ -443,15 +481,12 @@ def process_comments(post_id):
     content = request.form.get('comment')
     user_id = session.get('loggedin', None)
     if user_id:
-        user = User.get_user_by_id(user_id)
-        user_name = user.user_name
-        user_pic = user.profile_pic
+        if 'user_name' not in session:  # logged in before the profile was kept in the session
+            remember_profile(User.get_user_by_id(user_id))
         new_comment = Comment.create(content=content, user_id=user_id, post_id=post_id)
-        comment_id = new_comment.comment_id
-        comment_timestamp = new_comment.timestamp
-        has_delete_button = user_id == new_comment.user_id
-        return jsonify(user_id=user_id, user_name=user_name, user_pic=user_pic, content=content,
-                       has_delete_button=has_delete_button, comment_id=comment_id, comment_timestamp=comment_timestamp)
+        return jsonify(user_id=user_id, user_name=session['user_name'], user_pic=session['profile_pic'],
+                       content=content, has_delete_button=True, comment_id=new_comment.comment_id,
+                       comment_timestamp=new_comment.timestamp)
     else:
         return jsonify(user_id="undefined")
 
@@ -468,30 +503,48 @@ def delete_comment(comment_id):
 #######################################################################################################
 
 @app.route('/home/search', methods=['GET', 'POST'])
-def search_post_by_tag():
-    """the function that fetch the search user enters and pass it to the corresponding post list page"""
-    search = request.form.get('postsearch')
-    return redirect(url_for('post_by_tag', tag_name=str(search)))
+def search_posts():
+    """the search box of the navigation bar posts here: a tag goes to the posts with that tag, anything else is
+    searched for in the text of the posts, their choices and comments"""
+    if request.method == 'POST':
+        search = request.form.get('postsearch', '').strip()
+        if Tag.get_tag_by_name(search):
+            return redirect(url_for('post_by_tag', tag_name=search))
+        return redirect(url_for('search_posts', q=search))
+
+    search = request.args.get('q', '').strip()
+    pagination = Post.search(search, page=request.args.get('page', 1, type=int))
+    return render_template('search_results.html', posts=pagination.items, pagination=pagination, search=search)
 
 
 @app.route('/home/tag/<tag_name>')
 def post_by_tag(tag_name):
     """the function that shows the relevant post list based on the tags the user select"""
-    page = request.args.get('page', 1, type=int)
-    posts_all = Post.get_posts_by_tag(tag_name)
-    tag_names = [str(tag.tag_name) for tag in Tag.get_all_tags()]
+    cursor = request.args.get('cursor')
+    pagination = Post.get_posts_by_tag_page(tag=tag_name, cursor=cursor)
 
-    if posts_all:
-        post_ids = [post.post_id for post in posts_all]
-        session["post_ids"] = post_ids
-        pagination = Post.get_posts_by_tag_pagination(tag=tag_name, page=page)
+    if pagination.items:
+        session["feed"] = "tag:%s" % tag_name
         posts = pagination.items
-        return render_template('post_list_by_tag.html', posts=posts, tag_names=tag_names, tag_name=tag_name,
+        return render_template('post_list_by_tag.html', posts=posts, tag_name=tag_name,
                                pagination=pagination)
     else:
         flash('your search returns no relevant posts')
         return redirect(url_for('show_all_posts'))
 
+
+@app.route('/home/tags/suggest')
+def suggest_tags():
+    """the tags starting with what the user typed so far, for the typeahead of the tag inputs; the response carries
+    an ETag so the browser can revalidate it instead of downloading it again"""
+    prefix = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    response = jsonify(tags=Tag.suggest(prefix, limit))
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
 #######################################################################################################
 
 if __name__ == "__main__":
@@ -502,8 +555,15 @@ if __name__ == "__main__":
     PORT = int(os.environ.get('PORT', 5000))
 
     connect_to_db(app)
+    upload_pool.start(app)  # upload the images of new posts in the background
+    deletion_flusher.start(app)  # and delete the images of deleted posts
+    # with debug=True the app is served from a child process, the parent only restarts it; the log of the vote
+    # buffer must be owned by the one process serving the votes
+    if VOTE_BUFFER_SIZE and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_vote_buffer(app)  # write the votes behind
 
     # Use the DebugToolbar
     DebugToolbarExtension(app)
 
-    app.run(debug=True, host="0.0.0.0", port=PORT)
+    # threaded, so the streams of results don't hold up the other requests
+    app.run(debug=True, host="0.0.0.0", port=PORT, threaded=True)
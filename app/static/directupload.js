@@ -0,0 +1,33 @@
+// uploads the files picked in the post form straight to s3, with a form the server signs for each of them, and puts
+// the keys of the uploaded files in the hidden inputs the post form submits in their place
+var pendingUploads = 0;
+
+function directUpload(input, keyInput, submitButton) {
+    var file = input.files[0];
+    $(keyInput).val('');
+    if (!file) {
+        return;
+    }
+    pendingUploads += 1;
+    $(submitButton).prop('disabled', true);
+
+    $.post('/home/uploads/sign', {filename: file.name}).then(function(signed) {
+        var data = new FormData();
+        $.each(signed.fields, function(i, field) {
+            data.append(field.name, field.value);
+        });
+        data.append('file', file);  // s3 ignores the fields after the file
+        return $.ajax({url: signed.action, type: 'POST', data: data, processData: false, contentType: false})
+            .then(function() {
+                $(keyInput).val(signed.key);
+            });
+    }).fail(function(xhr) {
+        $(input).val('');
+        alert((xhr.responseJSON && xhr.responseJSON.error) || 'Your file could not be uploaded, please try again');
+    }).always(function() {
+        pendingUploads -= 1;
+        if (pendingUploads === 0) {
+            $(submitButton).prop('disabled', false);
+        }
+    });
+}
@@ -0,0 +1,26 @@
+// the tag suggestions for the typeahead of the tag inputs, fetched from the server as the user types;
+// the browser revalidates the responses with their ETag and Bloodhound caches them for the page
+var tagSuggestions = new Bloodhound({
+    datumTokenizer: Bloodhound.tokenizers.whitespace,
+    queryTokenizer: Bloodhound.tokenizers.whitespace,
+    remote: {
+        url: '/home/tags/suggest?q=%QUERY',
+        wildcard: '%QUERY',
+        transform: function(response) {
+            return response.tags;
+        }
+    }
+});
+
+function tagTypeahead(selector) {
+    return $(selector).typeahead({
+        hint: true,
+        highlight: true,
+        minLength: 1
+    },
+    {
+        name: 'tags',
+        source: tagSuggestions,
+        limit: 20  // above the number of suggestions the server sends, typeahead 0.11 drops remote results otherwise
+    });
+}
@@ -0,0 +1,285 @@
+"""Storage of the images users upload, in S3."""
+
+from Queue import Queue
+from StringIO import StringIO
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow only the original images are stored
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# the largest image the variants are made of; a few MB of compressed image can decode to gigabytes
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40 * 1000 * 1000))
+
+
+def connect_s3():
+    """connects to S3, or to the local stand-in of S3 (moto_server, minio, ...) at S3_HOST and S3_PORT if set"""
+    host = os.environ.get('S3_HOST')
+    if host:
+        return S3Connection(os.environ["AWS_ACCESS_KEY"], os.environ["AWS_SECRET_KEY"], host=host,
+                            port=int(os.environ.get('S3_PORT', 80)), is_secure=False,
+                            calling_format=OrdinaryCallingFormat())
+    return S3Connection(os.environ["AWS_ACCESS_KEY"], os.environ["AWS_SECRET_KEY"])
+
+
+class InvalidUpload(Exception):
+    """An upload that can't be used; the message tells the user why"""
+
+
+class UploadTooLarge(InvalidUpload):
+    """An upload bigger than the maximum size allowed"""
+
+
+def upload_form(conn, bucket_name, key_name, content_type, max_size, expires_in=600):
+    """the url and the fields of the form with which a browser uploads a file straight to key_name in the bucket;
+    the form is signed so s3 only takes a file of content_type of at most max_size bytes, within expires_in seconds.
+    The file goes in a last field named 'file'"""
+    return conn.build_post_form_args(bucket_name, key_name, expires_in=expires_in, acl='private',
+                                     max_content_length=max_size,
+                                     http_method='https' if conn.is_secure else 'http',
+                                     fields=[{'name': 'Content-Type', 'value': content_type}],
+                                     conditions=['{"Content-Type": "%s"}' % content_type])
+
+
+MD5_HEX = re.compile(r'^[0-9a-f]{32}$')
+
+
+class _Digester(object):
+    """a file hashing what is written to it"""
+
+    def __init__(self, digest):
+        self.write = digest.update
+
+
+def content_md5(key):
+    """the md5 of the content of the object at key, in hex. S3 gives it as the etag of an object uploaded in one
+    request; the etag of a multipart upload or of an object encrypted with KMS is something else, so the content of
+    those is read and hashed"""
+    etag = (key.etag or '').strip('"')
+    if MD5_HEX.match(etag) and getattr(key, 'encrypted', None) != 'aws:kms':
+        return etag
+    digest = hashlib.md5()
+    key.get_contents_to_file(_Digester(digest))
+    return digest.hexdigest()
+
+
+def variant_key(key_name, variant):
+    """the key of a scaled down variant of the image at key_name"""
+    return "%s_%s" % (key_name, variant)
+
+
+def image_variants(fp, sizes, max_pixels=MAX_IMAGE_PIXELS):
+    """scales the image in the file fp down to fit each of sizes, a dict of variant -> (width, height), and returns a
+    dict of variant -> jpeg data; empty if fp is not an image, has more than max_pixels pixels or Pillow isn't
+    installed. The size of an image is read from its header, before it is decoded"""
+    if Image is None:
+        return {}
+    try:
+        fp.seek(0)
+        original = Image.open(fp)
+        width, height = original.size
+        if width * height > max_pixels:
+            log.warning("no variants for an image of %dx%d pixels, more than %d", width, height, max_pixels)
+            return {}
+        if original.format == 'JPEG' and sizes:
+            # decodes at 1/2, 1/4 or 1/8 of the size when that still covers the largest variant
+            original.draft('RGB', max(sizes.values()))
+        original.load()
+    except (IOError, SyntaxError, ValueError):
+        return {}
+    if original.mode != 'RGB':
+        original = original.convert('RGB')
+
+    variants = {}
+    for variant, size in sizes.items():
+        image = original.copy()
+        image.thumbnail(size, Image.ANTIALIAS)
+        output = StringIO()
+        image.save(output, 'JPEG', quality=85, optimize=True)
+        variants[variant] = output.getvalue()
+    return variants
+
+
+class UploadPool(object):
+    """A pool of threads storing the images the browser uploaded to the bucket, so a request doesn't wait on S3.
+
+    submit_copy() queues the copy of an upload to the key the image is stored under and returns at once, unless
+    max_pending copies are already waiting, in which case it blocks until there is room. The images are copied within
+    s3 and stored together with the scaled down variants given as a dict of variant -> (width, height), next to the
+    original under variant_key(). Failed copies and uploads of variants are retried with exponential backoff, and
+    on_done(key_name, succeeded, variants) is called once the copy is over, with the variants that were stored,
+    within the context of the flask app given to start(). Until the pool is started the copies run synchronously in
+    the caller, which is what scripts and tests get."""
+
+    def __init__(self, bucket, workers=4, max_pending=100, retries=3, backoff=0.5, variants=None, sleep=time.sleep):
+        self.bucket = bucket
+        self.variants = variants or {}
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self._sleep = sleep
+        self._queue = Queue(maxsize=max_pending)
+        self._threads = []
+        self._app = None
+
+    @property
+    def started(self):
+        return bool(self._threads)
+
+    def start(self, app=None):
+        self._app = app
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name='upload-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit_copy(self, key_name, source_key_name, on_done=None):
+        """stores the object uploaded to the bucket at source_key_name under key_name, then deletes it; the object
+        is copied within s3 and only downloaded to make its variants"""
+        job = (key_name, source_key_name, on_done)
+        if self.started:
+            self._queue.put(job)
+        else:
+            self._run(job)
+
+    def join(self):
+        """waits until every upload submitted so far is over"""
+        self._queue.join()
+
+    def upload(self, key_name, fp, headers=None):
+        """uploads the content of the file fp as a public object, retrying on errors; returns True if it succeeded"""
+        def upload():
+            fp.seek(0)
+            self.bucket.new_key(key_name).set_contents_from_file(fp, headers=headers, policy='public-read')
+        return self._retry("upload of %s" % key_name, upload)
+
+    def copy(self, key_name, source_key_name):
+        """copies the object at source_key_name to a public object at key_name, retrying on errors; returns True if it
+        succeeded"""
+        return self._retry("copy of %s to %s" % (source_key_name, key_name), lambda: self.bucket.copy_key(
+            key_name, self.bucket.name, source_key_name, headers={'x-amz-acl': 'public-read'}))
+
+    def _retry(self, description, action):
+        for attempt in range(self.retries + 1):
+            try:
+                action()
+                return True
+            except Exception:
+                log.warning("%s failed (attempt %d)", description, attempt + 1, exc_info=True)
+                if attempt < self.retries:
+                    self._sleep(self.backoff * 2 ** attempt)
+        return False
+
+    def upload_variants(self, key_name, fp):
+        """stores the variants of the image in the file fp next to key_name; returns the variants stored"""
+        stored = []
+        for variant, variant_data in image_variants(fp, self.variants).items():
+            if self.upload(variant_key(key_name, variant), StringIO(variant_data),
+                           headers={'Content-Type': 'image/jpeg'}):
+                stored.append(variant)
+        return sorted(stored)
+
+    def store_variants(self, key_name):
+        """downloads the image at key_name and stores its variants; returns the variants stored"""
+        original = self.bucket.get_key(key_name)
+        if original is None:
+            return []
+        fp = tempfile.TemporaryFile()
+        try:
+            original.get_contents_to_file(fp)
+            return self.upload_variants(key_name, fp)
+        finally:
+            fp.close()
+
+    def _run(self, job):
+        key_name, source, on_done = job
+        succeeded = self.copy(key_name, source)
+        variants = []
+        if succeeded:
+            try:
+                variants = self.store_variants(key_name)
+            except Exception:
+                log.warning("the variants of %s could not be stored", key_name, exc_info=True)
+            try:
+                self.bucket.delete_key(source)
+            except Exception:  # left to the expiry rule of the uploads in the bucket
+                log.warning("the upload %s could not be deleted", source, exc_info=True)
+        if on_done:
+            on_done(key_name, succeeded, variants)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if self._app is not None:
+                    with self._app.app_context():
+                        self._run(job)
+                else:
+                    self._run(job)
+            except Exception:
+                log.exception("upload of %s could not be completed", job[0])
+            finally:
+                self._queue.task_done()
+
+
+class Flusher(object):
+    """A thread calling flush() every interval seconds, and as soon as notify() is called, within the context of the
+    flask app given to start(); it flushes once right after it starts, to pick up what was left over by a previous
+    run. Until it is started notify() calls flush() synchronously in the caller. Errors are logged, not raised: the
+    next flush is expected to retry what failed."""
+
+    def __init__(self, flush, interval=60):
+        self.flush = flush
+        self.interval = interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._app = None
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self, app=None):
+        self._app = app
+        self._thread = threading.Thread(target=self._work, name='flusher')
+        self._thread.daemon = True
+        self._thread.start()
+        self.notify()
+
+    def notify(self):
+        if self.started:
+            self._wake.set()
+        else:
+            self._run()
+
+    def run_once(self):
+        """flushes right away in the caller, e.g. at exit"""
+        self._run()
+
+    def _run(self):
+        try:
+            if self._app is not None:
+                with self._app.app_context():
+                    self.flush()
+            else:
+                self.flush()
+        except Exception:
+            log.exception("flush failed, it will be retried")
+
+    def _work(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._run()
@@ -0,0 +1,27 @@
+"""The app as deployed (see the Procfile): served by gunicorn with gevent workers, so thousands of pages can follow
+the results of their posts at once, each costing a greenlet rather than a worker:
+
+    gunicorn -k gevent --worker-connections 5000 wsgi:app
+
+With VOTE_BUFFER_SIZE set every worker buffers the votes it takes, logging them to VOTE_BUFFER_LOG suffixed with its
+pid, and adopts the logs of the workers gone before it. The app is loaded by every worker, so not with --preload."""
+
+try:
+    from gevent import monkey
+except ImportError:  # served by another server
+    monkey = None
+
+if monkey is not None and monkey.is_module_patched('socket'):
+    # the gevent workers patched the sockets; psycopg2 talks to postgresql on its own, so without this every query,
+    # the polling of the live results included, would block all the greenlets of the worker
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+from server import app
+from models import connect_to_db, upload_pool, deletion_flusher, start_vote_buffer, VOTE_BUFFER_SIZE
+
+connect_to_db(app)
+upload_pool.start(app)  # upload the images of new posts in the background
+deletion_flusher.start(app)  # and delete the images of deleted posts
+if VOTE_BUFFER_SIZE:
+    start_vote_buffer(app, per_process=True)  # write the votes behind
@@ -10,6 +10,7 @@ def create_app():
     app = Flask("test", template_folder=basedir + "/../app/templates")
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'opinionated-test.db')
     app.config['SERVER_NAME'] = 'localhost:5000'
+    app.secret_key = 'test'  # the feed pages remember the feed in the session
     app.debug = True
     db.app = app
     db.init_app(app)
@@ -18,9 +19,13 @@ def create_app():
 class BasicsTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
-        from app.server import login, show_all_posts
+        from app.server import app, login, show_all_posts, navigate_posts
+        self.app.jinja_env.filters.update(app.jinja_env.filters)  # the filters and helpers the templates use
+        self.app.jinja_env.globals.update(app.jinja_env.globals)
         self.app.add_url_rule('/', 'login', login)
         self.app.add_url_rule('/home', 'show_all_posts', show_all_posts)
+        self.app.add_url_rule('/home/post/<int:post_id>/next', 'navigate_posts', navigate_posts,
+                              defaults={'direction': 'next'})
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -44,4 +49,8 @@ class BasicsTestCase(unittest.TestCase):
         response = self.client.get('/home')
         print response
         self.assertTrue('Home' in response.data)
-        self.assertTrue('Featured tags' in response.data)
\ No newline at end of file
+        self.assertTrue('Featured Tags' in response.data)
+
+    def test_navigate_unknown_post(self):
+        response = self.client.get('/home/post/1/next')
+        self.assertEqual(404, response.status_code)
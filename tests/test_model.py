@@ -1,9 +1,23 @@
 import unittest
 from flask import Flask
-from app.models import User, Post, Choice, Comment, Follow, Tag, TagPost, Vote, db
+from app.models import User, Post, Choice, Comment, Follow, Tag, TagPost, Vote, TimelineEntry, db, results_cache, \
+    popular_tags_cache, tag_index
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from app.models import media_uploaded, media_url, Media, PendingDeletion, sign_upload, verify_upload, \
+    upload_key_prefix, UnitOfWork, SearchTerm
+import app.models
+from app.buffer import WriteBuffer, process_log_path, orphaned_logs
+from app.live import ResultsHub, event_stream
+from app.storage import UploadPool, InvalidUpload, UploadTooLarge, Image, image_variants, content_md5
+from StringIO import StringIO
 import os
-import werkzeug.datastructures
 import hashlib
+import json
+import shutil
+import tempfile
+import uuid
+from datetime import datetime
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -15,6 +29,59 @@ def create_app():
     db.init_app(app)
     return app
 
+class MemoryKey(object):
+    """an object of a MemoryBucket"""
+    def __init__(self, bucket, name):
+        self.bucket, self.name = bucket, name
+
+    @property
+    def size(self):
+        return len(self.bucket.objects[self.name][0])
+
+    @property
+    def content_type(self):
+        return self.bucket.objects[self.name][1]
+
+    @property
+    def etag(self):
+        return '"%s"' % hashlib.md5(self.bucket.objects[self.name][0]).hexdigest()
+
+    def set_contents_from_file(self, fp, headers=None, policy=None):
+        self.bucket.objects[self.name] = (fp.read(), (headers or {}).get('Content-Type', 'image/jpeg'))
+
+    def get_contents_to_file(self, fp):
+        fp.write(self.bucket.objects[self.name][0])
+
+
+class MultiDeleteResult(object):
+    errors = []
+
+
+class MemoryBucket(object):
+    """a bucket kept in memory, standing in for the s3 bucket in the tests"""
+    name = "test"
+
+    def __init__(self):
+        self.objects = {}  # key name -> (data, content type)
+
+    def new_key(self, key_name):
+        return MemoryKey(self, key_name)
+
+    def get_key(self, key_name):
+        return MemoryKey(self, key_name) if key_name in self.objects else None
+
+    def copy_key(self, key_name, bucket_name, source_key_name, headers=None):
+        self.objects[key_name] = self.objects[source_key_name]
+
+    def delete_key(self, key_name):
+        self.objects.pop(key_name, None)
+
+    def delete_keys(self, key_names, quiet=False):
+        for key_name in key_names:
+            self.delete_key(key_name)
+        return MultiDeleteResult()
+
+
 class BasicsTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
@@ -46,6 +113,22 @@ class UserModelTestCase(unittest.TestCase):
         self.assertNotEqual(u1.password_hash, u2.password_hash)
 
 class ModelTestCase(BasicsTestCase):
+    def setUp(self):
+        super(ModelTestCase, self).setUp()
+        self.bucket = MemoryBucket()
+        self.real_bucket = app.models.bucket
+        app.models.bucket = app.models.upload_pool.bucket = self.bucket
+
+    def tearDown(self):
+        app.models.bucket = app.models.upload_pool.bucket = self.real_bucket
+        super(ModelTestCase, self).tearDown()
+
+    def upload(self, user_id, data="", content_type="image/jpeg"):
+        """stores a file the way the browser uploads it, returning its key"""
+        key_name = upload_key_prefix(user_id) + uuid.uuid4().hex
+        self.bucket.objects[key_name] = (data, content_type)
+        return key_name
+
     def test_create_users(self):
         """test the creation of a user with friends"""
         u1 = User.create(user_id=111, email="aaa@gmail.com", password="", user_name="lgdfv", gender="female", location="Shenzhen, China",
@@ -71,8 +154,8 @@ class ModelTestCase(BasicsTestCase):
     """test a new post creation without filename and tags"""
     def test_create_post(self):
         """test to create a new post with file objects and make sure choices data are added to Choice table"""
-        file_object1 = werkzeug.datastructures.FileStorage(filename="fileupload1.JPG")
-        file_object2 = werkzeug.datastructures.FileStorage(filename="fileupload2.JPG")
+        file_object1 = self.upload(1)
+        file_object2 = self.upload(1)
         p = Post.create(author_id=1, description="test", file_name=None, tag_list=None, choice_data=[("text_choice1", file_object1), ("text_choice2", file_object2)])
         choices = Choice.get_choices_by_post_id(p.post_id)
         choices_text = [choice.choice_text for choice in choices]
@@ -82,14 +165,15 @@ class ModelTestCase(BasicsTestCase):
         self.assertEqual(p.file_name, None)
         self.assertIn("text_choice1", choices_text)
         self.assertIn("text_choice2", choices_text)
-        self.assertEqual([p], Post.get_all_posts())
-        for choice in choices:
-            self.assertIn(hashlib.sha512(str(choice.choice_id)).hexdigest(), choices_file)
+        self.assertEqual([p], Post.get_all_posts_page().items)
+        # the images are stored under the hash of their content; both files here are empty, so only one is kept
+        self.assertEqual([hashlib.md5("").hexdigest()] * 2, choices_file)
+        self.assertEqual([hashlib.md5("").hexdigest()], self.bucket.objects.keys())
         return p
 
     def test_get_all_tags_by_post_id(self):
-        file_object1 = werkzeug.datastructures.FileStorage(filename="fileupload1.JPG")
-        file_object2 = werkzeug.datastructures.FileStorage(filename="fileupload2.JPG")
+        file_object1 = self.upload(1)
+        file_object2 = self.upload(1)
         p = Post.create(author_id=1, description="test", file_name=None, tag_list="food,fashion", choice_data=[("text_choice1", file_object1), ("text_choice2", file_object2)])
         tags = Tag.get_tags_by_post_id(p.post_id)
         tag_names = [str(tag.tag_name) for tag in tags]
@@ -98,19 +182,19 @@ class ModelTestCase(BasicsTestCase):
         self.assertNotIn("apple", tag_names)
 
     def test_get_post_by_tag_name(self):
-        file_object1 = werkzeug.datastructures.FileStorage(filename="fileupload1.JPG")
-        file_object2 = werkzeug.datastructures.FileStorage(filename="fileupload2.JPG")
+        file_object1 = self.upload(1)
+        file_object2 = self.upload(1)
         p = Post.create(author_id=1, description="test", file_name=None, tag_list="food,fashion", choice_data=[("text_choice1", file_object1), ("text_choice2", file_object2)])
-        self.assertIn(p, Post.get_posts_by_tag("food"))
-        self.assertIn(p, Post.get_posts_by_tag("fashion"))
-        self.assertNotIn(p, Post.get_posts_by_tag("apple"))
+        self.assertIn(p, Post.get_posts_by_tag_page("food").items)
+        self.assertIn(p, Post.get_posts_by_tag_page("fashion").items)
+        self.assertNotIn(p, Post.get_posts_by_tag_page("apple").items)
 
 
     def test_show_all_followed_posts(self):
         """test the show_all_followed_posts method"""
         u1, u2 = self.test_create_users()
-        file_object1 = werkzeug.datastructures.FileStorage(filename="fileupload1.JPG")
-        file_object2 = werkzeug.datastructures.FileStorage(filename="fileupload2.JPG")
+        file_object1 = self.upload(u1.user_id)
+        file_object2 = self.upload(u1.user_id)
         p1 = Post.create(author_id=u1.user_id, description="test", file_name=None, tag_list=None, choice_data=[("text_choice1", file_object1), ("text_choice2", file_object2)])
         all_followed_post = u2.followed_posts()
         self.assertIn(p1, all_followed_post)
@@ -144,6 +228,795 @@ class ModelTestCase(BasicsTestCase):
         self.assertEqual(total_votes, 2)
         self.assertEqual({c1:1, c2:1}, vote_dict)
 
+    def test_tally_votes(self):
+        """test the grouped tally counts choices without votes and builds the doughnut chart rows"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        choices = Choice.get_choices_by_post_id(p.post_id)
+        c1, c2 = [choice.choice_id for choice in choices][0], [choice.choice_id for choice in choices][1]
+        Vote.create(user_id=u1.user_id, choice_id=c1)
+        Vote.create(user_id=u2.user_id, choice_id=c1)
+        vote_dict, total_votes, chart_lst = p.tally_votes()
+        self.assertEqual({c1:2, c2:0}, vote_dict)
+        self.assertEqual(total_votes, 2)
+        self.assertEqual([["Choice", "Votes"], ["text_choice1", 2], ["text_choice2", 0]], chart_lst)
+        self.assertEqual(chart_lst, p.doughnut_chart())
+
+
+    def test_voter_charts_with_three_choices(self):
+        """test the cross tab breaks the votes down by gender, location and age for any number of choices"""
+        u1, u2 = self.test_create_users()
+        u3 = User.create(user_id=113, email="ccc@gmail.com", password="", user_name="male voter", gender="male",
+                         location="Boston, MA", age_range=21, profile_pic="")
+        p = Post.create(author_id=u1.user_id, description="three choices", file_name=None, tag_list=None,
+                        choice_data=[("red", None), ("green", None), ("blue", None)])
+        c1, c2, c3 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        Vote.create(user_id=u1.user_id, choice_id=c1)
+        Vote.create(user_id=u2.user_id, choice_id=c3)
+        Vote.create(user_id=u3.user_id, choice_id=c3)
+        gender, location, age = p.voter_charts()
+        self.assertEqual(["Choices", "red", "green", "blue", {"role": 'annotation'}], gender[0])
+        self.assertEqual(["Female", 1, 0, 1, ""], gender[1])
+        self.assertEqual(["Male", 0, 0, 1, ""], gender[2])
+        self.assertEqual([["City", "red", "green", "blue"], ["Boston", 0, 0, 1], ["Shenzhen", 1, 0, 1]], location)
+        self.assertEqual([["Age group", "red", "green", "blue"], ["21", 0, 0, 1], ["55", 1, 0, 1]], age)
+        self.assertEqual(gender, p.bar_chart_gender())
+
+    def test_vote_counts_maintained(self):
+        """test the vote counts on the choices follow creating, changing and deleting votes, and can be rebuilt"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        v1 = Vote.create(user_id=u1.user_id, choice_id=c1)
+        Vote.create(user_id=u2.user_id, choice_id=c1)
+        Vote.update_vote(v1.vote_id, c2)
+        self.assertEqual([1, 1], [choice.vote_count for choice in Choice.get_choices_by_post_id(p.post_id)])
+        db.session.delete(u2)
+        db.session.commit()
+        self.assertEqual([0, 1], [choice.vote_count for choice in Choice.get_choices_by_post_id(p.post_id)])
+        self.assertEqual(1, p.total_votes)
+
+        Choice.query.update({Choice.vote_count: 7})
+        db.session.commit()
+        Choice.reconcile_vote_counts(post_id=p.post_id)
+        self.assertEqual([0, 1], [choice.vote_count for choice in Choice.get_choices_by_post_id(p.post_id)])
+
+    def test_cast_vote(self):
+        """test a vote is cast with one statement, moved between the choices of its post and never duplicated"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        other = Post.create(author_id=1, description="other", file_name=None, tag_list=None,
+                            choice_data=[("x", None), ("y", None)])
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        version, user_id, post_id = p.version, u1.user_id, p.post_id
+
+        statements = []
+        record = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual((True, None), Vote.cast(user_id, post_id, c1))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(1, len(statements))
+        self.assertEqual(version + 1, p.version)
+
+        self.assertEqual((False, None), Vote.cast(u1.user_id, p.post_id, c1))  # the same vote again
+        self.assertEqual((True, c1), Vote.cast(u1.user_id, p.post_id, c2))
+        other_choice = other.choices[0].choice_id
+        self.assertEqual((False, None), Vote.cast(u1.user_id, p.post_id, other_choice))  # not a choice of p
+        self.assertEqual((True, None), Vote.cast(u2.user_id, p.post_id, c2))
+        self.assertEqual([0, 2], [choice.vote_count for choice in Choice.get_choices_by_post_id(p.post_id)])
+        self.assertEqual(version + 3, p.version)
+        self.assertEqual(c2, p.check_choice_on_post_by_user_id(u1.user_id))
+
+        self.assertRaises(IntegrityError, Vote.create, user_id=u1.user_id, choice_id=c1)
+        db.session.rollback()
+        self.assertEqual(2, Vote.query.filter_by(post_id=p.post_id).count())
+
+    def test_vote_buffer(self):
+        """test buffered votes are coalesced, written with bulk upserts, shown to their voter meanwhile and replayed
+        from the log after a crash"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        log_dir = tempfile.mkdtemp()
+        real_buffer, app.models.vote_buffer = app.models.vote_buffer, \
+            WriteBuffer(Vote.cast_many, max_size=3, log_path=os.path.join(log_dir, "votes.log"))
+        try:
+            app.models.vote_buffer.start()
+            Vote.cast_later(u1.user_id, p.post_id, c1)
+            Vote.cast_later(u2.user_id, p.post_id, c1)
+            Vote.cast_later(u1.user_id, p.post_id, c2)  # replaces the first vote
+            self.assertEqual(2, len(app.models.vote_buffer))
+            self.assertEqual(0, Vote.query.count())
+            self.assertEqual(c2, p.voted_choice(u1.user_id))
+            self.assertEqual({c1: 0, c2: 1}, p.results_for(u1)['vote_dict'])  # only their own vote is counted
+
+            # a new buffer on the same log stands for the process restarted after a crash
+            app.models.vote_buffer = WriteBuffer(Vote.cast_many, max_size=3, log_path=os.path.join(log_dir, "votes.log"))
+            app.models.vote_buffer.start()
+            self.assertEqual(2, len(app.models.vote_buffer))
+            statements = []
+            record = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                self.assertEqual(2, app.models.vote_buffer.flush())
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual(1, len(statements))
+            self.assertEqual([1, 1], [choice.vote_count for choice in Choice.get_choices_by_post_id(p.post_id)])
+            self.assertEqual(c2, p.check_choice_on_post_by_user_id(u1.user_id))
+            self.assertEqual(0, len(app.models.vote_buffer))
+            self.assertEqual("", open(os.path.join(log_dir, "votes.log")).read())
+        finally:
+            app.models.vote_buffer = real_buffer
+            shutil.rmtree(log_dir)
+
+    def test_write_buffer_adopts_logs(self):
+        """test a buffer of one of several processes replays the logs of the processes gone, and only those"""
+        log_dir = tempfile.mkdtemp()
+        base_path = os.path.join(log_dir, "votes.log")
+        gone_path = base_path + ".4194305"  # above the largest pid there can be
+        running_path = "%s.%d" % (base_path, os.getppid())
+        for path, entries in [(base_path, [["c", 1]]), (gone_path + ".flushing", [["a", 1]]),
+                              (gone_path, [["a", 2], ["b", 1]]), (running_path, [["d", 1]])]:
+            with open(path, "w") as fp:
+                fp.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        written = []
+        try:
+            self.assertEqual([base_path, gone_path], orphaned_logs(base_path))
+            write_buffer = WriteBuffer(written.extend, log_path=process_log_path(base_path))
+            write_buffer.start(orphaned_logs(base_path))
+            self.assertEqual(3, len(write_buffer))
+            self.assertEqual(2, write_buffer.pending("a"))
+            self.assertEqual(sorted(["votes.log.%d" % os.getpid(), os.path.basename(running_path)]),
+                             sorted(os.listdir(log_dir)))
+            self.assertEqual(3, write_buffer.flush())
+            self.assertEqual([1, 2, 1], written)
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_vote_buffer_dead_letter(self):
+        """test a vote that can't be written doesn't hold back the others, and is given up after max_attempts"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        log_dir = tempfile.mkdtemp()
+        dead_letter_path = os.path.join(log_dir, "votes.dead")
+        vote_buffer = WriteBuffer(Vote.cast_many, log_path=os.path.join(log_dir, "votes.log"), max_attempts=2,
+                                  dead_letter_path=dead_letter_path)
+        try:
+            vote_buffer.start()
+            vote_buffer.add((u1.user_id, p.post_id), [u1.user_id, p.post_id, c1, "2016-01-01T00:00:00.000000"])
+            vote_buffer.add((u2.user_id, p.post_id), [u2.user_id, p.post_id, c2, "garbled"])
+            self.assertEqual(1, vote_buffer.flush())
+            self.assertEqual(c1, p.check_choice_on_post_by_user_id(u1.user_id))
+            self.assertEqual(1, len(vote_buffer))  # retried with the next flush
+            self.assertFalse(os.path.exists(dead_letter_path))
+
+            self.assertEqual(0, vote_buffer.flush())
+            self.assertEqual(0, len(vote_buffer))
+            self.assertEqual([[[u2.user_id, p.post_id], [u2.user_id, p.post_id, c2, "garbled"]]],
+                             [json.loads(line) for line in open(dead_letter_path)])
+            self.assertEqual("", open(os.path.join(log_dir, "votes.log")).read())
+            self.assertEqual(1, Vote.query.count())
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_results_cache_concurrent_vote(self):
+        """test the results aren't cached under a version read before a vote another request committed meanwhile"""
+        results_cache.clear()
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        version = p.version
+        aggregate_votes = p.aggregate_votes
+
+        def vote_meanwhile():
+            with db.engine.begin() as connection:  # another request, on a connection of its own
+                connection.execute(Vote.__table__.insert(), user_id=u1.user_id, choice_id=c1, post_id=p.post_id,
+                                   timestamp=datetime.utcnow())
+            return aggregate_votes()
+        p.aggregate_votes = vote_meanwhile
+        self.assertEqual({c1: 1, c2: 0}, p.get_results()['vote_dict'])
+        self.assertIsNone(results_cache.get(p.post_id, version))
+        del p.aggregate_votes
+
+        written, previous_vote = Vote.cast(u2.user_id, p.post_id, c1)
+        p.apply_vote_to_results(u2, previous_vote, c1, version)
+        self.assertEqual({c1: 2, c2: 0}, p.get_results()['vote_dict'])
+        self.assertEqual(p.aggregate_votes(), results_cache.get(p.post_id, p.version))
+
+    def test_results_cache(self):
+        """test the results are cached per post version and patched in place by a vote"""
+        results_cache.clear()
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        Vote.create(user_id=u1.user_id, choice_id=c1)
+        results = p.get_results()
+        self.assertEqual({c1: 1, c2: 0}, results['vote_dict'])
+        self.assertIsNotNone(results_cache.get(p.post_id, p.version))
+
+        version = p.version
+        Vote.create(user_id=u2.user_id, choice_id=c2)
+        self.assertEqual(version + 1, p.version)
+        p.apply_vote_to_results(u2, None, c2, version)
+        self.assertEqual(p.aggregate_votes(), results_cache.get(p.post_id, p.version))
+
+        version = p.version
+        Vote.update_vote(Vote.get_vote_by_post_and_user_id(p.post_id, u1.user_id), c2)
+        p.apply_vote_to_results(u1, c1, c2, version)
+        self.assertEqual(p.aggregate_votes(), results_cache.get(p.post_id, p.version))
+        self.assertEqual({c1: 0, c2: 2}, p.get_results()['vote_dict'])
+
+        # the votes of a voter changing their profile are counted afresh, not moved out of buckets they left
+        version = p.version
+        u1.update_user_info(gender="male" if u1.gender != "male" else "female")
+        self.assertEqual(version + 1, p.version)
+        version = p.version
+        p.get_results()
+        self.assertEqual(p.aggregate_votes(), results_cache.get(p.post_id, version))
+        Vote.update_vote(Vote.get_vote_by_post_and_user_id(p.post_id, u1.user_id), c1)
+        p.apply_vote_to_results(u1, c2, c1, version)
+        self.assertEqual(p.aggregate_votes(), results_cache.get(p.post_id, p.version))
+
+    def test_cursor_pagination(self):
+        """test the cursor pages walk the posts newest first, forwards and backwards, including equal timestamps"""
+        same_time = datetime(2015, 9, 1, 12, 0, 0)
+        for day in [1, 1, 2, 3, 4]:
+            timestamp = same_time if day == 1 else datetime(2015, 9, day, 12, 0, 0)
+            db.session.add(Post(author_id=1, description="day %d" % day, timestamp=timestamp))
+        db.session.commit()
+        expected = [post.post_id for post in Post.query.order_by(Post.timestamp.desc(), Post.post_id.desc())]
+
+        page1 = Post.get_all_posts_page(per_page=2)
+        self.assertFalse(page1.has_prev)
+        page2 = Post.get_all_posts_page(page1.next_cursor, per_page=2)
+        page3 = Post.get_all_posts_page(page2.next_cursor, per_page=2)
+        self.assertFalse(page3.has_next)
+        self.assertEqual(expected, [post.post_id for page in (page1, page2, page3) for post in page.items])
+
+        back = Post.get_all_posts_page(page3.prev_cursor, per_page=2)
+        self.assertEqual([post.post_id for post in page2.items], [post.post_id for post in back.items])
+        back = Post.get_all_posts_page(back.prev_cursor, per_page=2)
+        self.assertEqual([post.post_id for post in page1.items], [post.post_id for post in back.items])
+        self.assertFalse(back.has_prev)
+        self.assertEqual(expected[:2], [post.post_id for post in Post.get_all_posts_page("not a cursor", 2).items])
+
+    def test_neighbour_in_feed(self):
+        """test the previous and next posts are looked up within the feed the user is browsing"""
+        u1, u2 = self.test_create_users()
+        p1 = Post.create(author_id=u1.user_id, description="first", file_name=None, tag_list="food", choice_data=[])
+        p2 = Post.create(author_id=u2.user_id, description="second", file_name=None, tag_list=None, choice_data=[])
+        p3 = Post.create(author_id=u1.user_id, description="third", file_name=None, tag_list="food", choice_data=[])
+        self.assertEqual(p2, p3.get_neighbour_in_feed("all", "next"))
+        self.assertEqual(p3, p2.get_neighbour_in_feed("all", "prev"))
+        self.assertIsNone(p3.get_neighbour_in_feed("all", "prev"))
+        self.assertEqual(p1, p3.get_neighbour_in_feed("tag:food", "next"))
+        self.assertEqual(p1, p3.get_neighbour_in_feed("followed:%d" % u2.user_id, "next"))
+        self.assertEqual(p1, p3.get_neighbour_in_feed("author:%d" % u1.user_id, "next"))
+        self.assertIsNone(p1.get_neighbour_in_feed("author:%d" % u1.user_id, "next"))
+
+    def test_feed_query_count(self):
+        """test rendering a page of posts costs the same number of queries whatever the page size"""
+        u1, u2 = self.test_create_users()
+        for i in range(10):
+            Post.create(author_id=u1.user_id, description="post %d" % i, file_name=None, tag_list="food,fashion",
+                        choice_data=[("text_choice1", None), ("text_choice2", None)])
+
+        def count_queries(per_page):
+            db.session.expire_all()
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                for post in Post.get_all_posts_page(per_page=per_page).items:
+                    post.author.user_name, post.total_votes, post.tags
+                    [choice.choice_text for choice in post.choices]
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            return len(statements)
+
+        self.assertEqual(3, count_queries(2))
+        self.assertEqual(3, count_queries(10))
+
+    def test_timeline(self):
+        """test the followed feed is written on post and follow, purged on unfollow, and merges unfanned authors"""
+        u1, u2 = self.test_create_users()  # u2 follows u1
+        u3 = User.create(user_id=113, email="ccc@gmail.com", password="", user_name="famous", gender="male",
+                         location=None, age_range=21, profile_pic="")
+        p1 = Post.create(author_id=u1.user_id, description="by u1", file_name=None, tag_list=None, choice_data=[])
+        p3 = Post.create(author_id=u3.user_id, description="by u3", file_name=None, tag_list=None, choice_data=[])
+        self.assertEqual([p1], u2.followed_posts())
+        self.assertEqual(1, TimelineEntry.query.filter_by(user_id=u2.user_id).count())
+
+        u2.follow(u3)  # the existing post of u3 is backfilled
+        self.assertEqual([p3, p1], u2.followed_posts_page().items)
+        u2.unfollow(u1)
+        self.assertEqual([p3], u2.followed_posts())
+        self.assertTrue(u1.is_following(u2) is False and u2.is_following(u3))
+
+        u3.fanout_on_read = True
+        db.session.commit()
+        p4 = Post.create(author_id=u3.user_id, description="by u3 again", file_name=None, tag_list=None, choice_data=[])
+        self.assertEqual(1, TimelineEntry.query.filter_by(user_id=u2.user_id).count())
+        self.assertEqual([p4, p3], u2.followed_posts_page().items)
+
+        TimelineEntry.rebuild()  # the posts of unfanned authors are left out of the timelines
+        self.assertEqual(0, TimelineEntry.query.filter_by(user_id=u2.user_id).count())
+        self.assertEqual([p4, p3], u2.followed_posts())
+
+    def test_follow_pages(self):
+        """test the paginated follower and followee listings return (user, since) pairs"""
+        u1 = User.create(user_id=1, email="a@gmail.com", password="", user_name="a", gender="female", age_range=21,
+                         profile_pic="")
+        fans = [User.create(user_id=10 + i, email="f@gmail.com", password="", user_name="f%d" % i, gender="male",
+                            age_range=21, profile_pic="", friend_ids=[1]) for i in range(3)]
+        page = u1.get_followers_page(1, per_page=2)
+        self.assertEqual(3, page.total)
+        self.assertEqual(2, len(page.items))
+        user, since = page.items[0]
+        self.assertIn(user, fans)
+        self.assertIsInstance(since, datetime)
+        self.assertEqual(1, len(u1.get_followers_page(2, per_page=2).items))
+        self.assertEqual([(u1, fans[0].followed.first().timestamp)], fans[0].get_followeds_page().items)
+
+    def test_follow_friends(self):
+        """test the friends who use the app are followed in bulk, together with their posts"""
+        friends = [User.create(user_id=10 + i, email="f@gmail.com", password="", user_name="f%d" % i, gender="male",
+                               age_range=21, profile_pic="") for i in range(3)]
+        p1 = Post.create(author_id=10, description="a", file_name=None, tag_list=None,
+                         choice_data=[("x", None), ("y", None)])
+        u1 = User.create(user_id=1, email="a@gmail.com", password="", user_name="a", gender="female", age_range=21,
+                         profile_pic="", friend_ids=[10, 999])
+        self.assertEqual([p1], u1.followed_posts())
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual([11, 12], u1.follow_friends([1, 10, 11, 12, 998]))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(4, len(statements))  # resolve the friends, insert the follows, flag and backfill the authors
+        self.assertEqual(set(friends), set(u1.get_all_followeds().keys()))
+        self.assertEqual([], u1.follow_friends([10, 11]))
+
+    def test_tag_post_counts(self):
+        """test the post counts of the tags follow the posts and feed the cached leaderboard"""
+        popular_tags_cache.clear()
+        posts = [Post.create(author_id=1, description="post %d" % i, file_name=None, tag_list=tags,
+                             choice_data=[("x", None), ("y", None)])
+                 for i, tags in enumerate(["food,fashion", "food", "food,tech"])]
+        self.assertEqual([("food", 3), ("fashion", 1), ("tech", 1)],
+                         [(tag.tag_name, tag.post_count) for tag in Tag.get_most_popular_tags(6)])
+        self.assertEqual(["food"], [tag.tag_name for tag in Tag.get_most_popular_tags(1)])
+
+        self.app.secret_key = 'test'  # deleting a post flashes a message
+        with self.app.test_request_context():
+            Post.delete_by_post_id(posts[0].post_id)
+        self.assertEqual(0, Tag.get_tag_by_name("fashion").post_count)
+        self.assertEqual(3, Tag.get_most_popular_tags(1)[0].post_count)  # the leaderboard is served from the cache
+        popular_tags_cache.clear()
+        self.assertEqual([("food", 2), ("tech", 1), ("fashion", 0)],
+                         [(tag.tag_name, tag.post_count) for tag in Tag.get_most_popular_tags(6)])
+
+        Tag.query.update({Tag.post_count: 0})
+        self.assertEqual(3, Tag.reconcile_post_counts())
+        self.assertEqual([2, 1, 0], [tag.post_count for tag in Tag.sort_all_tags_by_popularity()])
+
+    def test_tag_suggest(self):
+        """test the tag suggestions match the prefix case insensitively and rank the most used tags first"""
+        popular_tags_cache.clear()
+        tag_index.load([])
+        for tags in ["food,Fashion", "fashion", "fashion,tech"]:
+            Post.create(author_id=1, description="post", file_name=None, tag_list=tags,
+                        choice_data=[("x", None), ("y", None)])
+        tag_index.load(db.session.query(Tag.tag_name, Tag.post_count))
+        self.assertEqual(["fashion", "Fashion", "food"], Tag.suggest("f"))
+        self.assertEqual(["fashion", "Fashion"], Tag.suggest("FA"))
+        self.assertEqual(["fashion"], Tag.suggest("f", limit=1))
+        self.assertEqual([], Tag.suggest("x"))
+        self.assertEqual(["fashion", "food"], Tag.suggest("", limit=2))
+
+        Tag.create("fable")  # new tags are suggested right away
+        self.assertEqual(["fashion", "Fashion", "fable"], Tag.suggest("fa"))
+
+        @UnitOfWork()
+        def failing_request():
+            Tag.create("fake")
+            Post.create(author_id=1, description="post", file_name=None, tag_list="faux",
+                        choice_data=[("x", None), ("y", None)])
+            self.assertEqual(["fashion", "Fashion", "fable"], Tag.suggest("fa"))  # not until committed
+            raise ValueError("the request failed")
+
+        self.assertRaises(ValueError, failing_request)
+        self.assertEqual(["fashion", "Fashion", "fable"], Tag.suggest("fa"))
+        Post.create(author_id=1, description="post", file_name=None, tag_list="faux",
+                    choice_data=[("x", None), ("y", None)])
+        self.assertEqual(["fashion", "Fashion", "fable", "faux"], Tag.suggest("fa"))
+
+    def test_create_post_transaction(self):
+        """test a post is created with its tags and choices in a single commit, reusing the existing tags"""
+        Tag.create("food")
+        commits = []
+        record = lambda conn: commits.append(conn)
+        event.listen(db.engine, 'commit', record)
+        try:
+            p = Post.create(author_id=1, description="post", file_name=None, tag_list="food, tech,,food",
+                            choice_data=[("x", None), ("y", None)])
+        finally:
+            event.remove(db.engine, 'commit', record)
+        self.assertEqual(1, len(commits))
+        self.assertEqual(["food", "tech"], [tag.tag_name for tag in p.tags])
+        self.assertEqual(2, Tag.query.count())
+        self.assertEqual([1, 1], [tag.post_count for tag in p.tags])
+        self.assertEqual(["x", "y"], [choice.choice_text for choice in p.choices])
+
+    def test_upload_pool(self):
+        """test the upload pool retries failed copies with backoff and reports how each copy ended"""
+        class FlakyBucket(object):
+            name = "bucket"
+
+            def __init__(self, failures):
+                self.failures, self.attempts, self.contents = failures, {}, {"uploads/" + key: "data " + key
+                                                                             for key in failures}
+
+            def copy_key(self, key_name, bucket_name, source_key_name, headers=None):
+                self.attempts[key_name] = self.attempts.get(key_name, 0) + 1
+                if self.attempts[key_name] <= self.failures[key_name]:
+                    raise IOError("S3 is unavailable")
+                self.contents[key_name] = self.contents[source_key_name]
+
+            def get_key(self, key_name):
+                return None  # no variants are made
+
+            def delete_key(self, key_name):
+                del self.contents[key_name]
+
+        bucket = FlakyBucket({"a": 2, "b": 0, "c": 9})
+        delays, results = [], []
+        on_done = lambda key_name, succeeded, variants: results.append((key_name, succeeded))
+        pool = UploadPool(bucket, workers=2, retries=3, backoff=0.5, sleep=delays.append)
+        pool.start(self.app)
+        for key_name in ["a", "b", "c"]:
+            pool.submit_copy(key_name, "uploads/" + key_name, on_done=on_done)
+        pool.join()
+        self.assertEqual([("a", True), ("b", True), ("c", False)], sorted(results))
+        self.assertEqual({"a": "data a", "b": "data b", "uploads/c": "data c"}, bucket.contents)
+        self.assertEqual({"a": 3, "b": 1, "c": 4}, bucket.attempts)
+        self.assertEqual([0.5, 0.5, 1.0, 1.0, 2.0], sorted(delays))
+
+    def test_media_state(self):
+        """test the image of a post is shown once uploaded, and not while pending or after a failed upload"""
+        p = Post.create(author_id=1, description="test", file_name=self.upload(1), tag_list=None,
+                        choice_data=[("text_choice1", None), ("text_choice2", None)])
+        self.assertEqual("ready", p.media_state)  # the pool isn't started, so the upload is over already
+        self.assertTrue(p.media_ready)
+
+        p.media_state = "pending"
+        db.session.commit()
+        self.assertFalse(p.media_ready)
+        media_uploaded(p.file_name, False)
+        self.assertEqual("failed", p.media_state)
+        self.assertFalse(p.media_ready)
+
+    def test_pending_deletions(self):
+        """test the images of a deleted post are queued and deleted from s3 in batches, keeping the failed ones"""
+        class Result(object):
+            def __init__(self, errors):
+                self.errors = errors
+
+        class Error(object):
+            def __init__(self, key):
+                self.key = key
+
+        class Bucket(object):
+            def __init__(self, failing):
+                self.failing, self.requests = failing, []
+
+            def delete_keys(self, key_names, quiet=False):
+                self.requests.append(list(key_names))
+                return Result([Error(key_name) for key_name in key_names if key_name in self.failing])
+
+        s3_bucket = Bucket(failing=set(["c"]))
+        real_bucket, app.models.bucket = app.models.bucket, s3_bucket
+        try:
+            PendingDeletion.queue(["a", "b", "c", "d", "e"])
+            PendingDeletion.queue(["a"])  # keys already queued are skipped
+            db.session.commit()
+            self.assertEqual(4, PendingDeletion.flush(batch_size=2))
+            self.assertEqual([["a", "b"], ["c", "d"], ["e"]], s3_bucket.requests)
+            self.assertEqual([("c", 1)], db.session.query(PendingDeletion.key_name, PendingDeletion.attempts).all())
+
+            p = Post.create(author_id=1, description="test", file_name=None, tag_list=None,
+                            choice_data=[("text_choice1", None), ("text_choice2", None)])
+            p.file_name = "post image"
+            p.choices[0].file_name = "choice image"
+            db.session.commit()
+            s3_bucket.failing = set()
+            self.app.secret_key = 'test'  # deleting a post flashes a message
+            with self.app.test_request_context():
+                Post.delete_by_post_id(p.post_id)
+            self.assertEqual(["c", "choice image", "choice image_medium", "choice image_thumb", "post image",
+                              "post image_medium", "post image_thumb"], s3_bucket.requests[-1])
+            self.assertEqual(0, PendingDeletion.query.count())
+        finally:
+            app.models.bucket = real_bucket
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_image_variants(self):
+        """test the variants of an image are scaled down to fit their size, and templates link to them once stored"""
+        original = StringIO()
+        Image.new('RGBA', (1000, 500), (255, 0, 0, 128)).save(original, 'PNG')
+        variants = image_variants(original, {'thumb': (320, 320), 'medium': (800, 800)})
+        self.assertEqual((320, 160), Image.open(StringIO(variants['thumb'])).size)
+        self.assertEqual((800, 400), Image.open(StringIO(variants['medium'])).size)
+        self.assertEqual('JPEG', Image.open(StringIO(variants['medium'])).format)
+        self.assertEqual({}, image_variants(StringIO("not an image"), {'thumb': (320, 320)}))
+        self.assertEqual({}, image_variants(original, {'thumb': (320, 320)}, max_pixels=1000 * 499))
+        photo = StringIO()
+        Image.new('RGB', (3200, 1600), (0, 0, 255)).save(photo, 'JPEG')
+        self.assertEqual((320, 160), Image.open(StringIO(image_variants(photo, {'thumb': (320, 320)})['thumb'])).size)
+
+        p = Post.create(author_id=1, description="test", file_name=self.upload(1, original.getvalue(), "image/png"), tag_list=None,
+                        choice_data=[("text_choice1", None), ("text_choice2", None)])
+        self.assertTrue(p.media_variants)
+        self.assertTrue(media_url(p, 'thumb').endswith(p.file_name + "_thumb"))
+        p.media_variants = False  # images from before the variants link to the original
+        self.assertTrue(media_url(p, 'thumb').endswith(p.file_name))
+
+    def test_media_acquire(self):
+        """test an image is referred to once per acquire, whoever inserted its row, and a failed image is uploaded
+        again by one post only"""
+        with db.engine.begin() as connection:  # another request stored the image
+            connection.execute(Media.__table__.insert(), key_name="k", ref_count=1, state="ready", variants=True)
+        media, needs_upload = Media.acquire("k")
+        self.assertEqual(("ready", True, False), (media.state, media.variants, needs_upload))
+        media, needs_upload = Media.acquire("new")
+        self.assertEqual(("pending", False, True), (media.state, media.variants, needs_upload))
+        Media.query.filter_by(key_name="new").update({Media.state: "failed"})
+        self.assertTrue(Media.acquire("new")[1])
+        self.assertFalse(Media.acquire("new")[1])  # being uploaded again already
+        db.session.commit()
+        self.assertEqual([("k", 2, "ready"), ("new", 3, "pending")],
+                         db.session.query(Media.key_name, Media.ref_count, Media.state).order_by(Media.key_name).all())
+
+    def test_media_dedup(self):
+        """test an image already stored isn't uploaded again, and its object is only deleted with its last post"""
+        uploaded = []
+        real_submit_copy = app.models.upload_pool.submit_copy
+
+        def submit_copy(key_name, source_key_name, on_done=None):
+            uploaded.append(key_name)
+            real_submit_copy(key_name, source_key_name, on_done)
+
+        image = lambda data: self.upload(1, data)
+        app.models.upload_pool.submit_copy = submit_copy
+        try:
+            p1 = Post.create(author_id=1, description="test", file_name=image("same"), tag_list=None,
+                             choice_data=[("text_choice1", image("same")), ("text_choice2", image("other"))])
+            p2 = Post.create(author_id=1, description="test", file_name=image("same"), tag_list=None,
+                             choice_data=[("text_choice1", None), ("text_choice2", None)])
+        finally:
+            del app.models.upload_pool.submit_copy
+        same, other = hashlib.md5("same").hexdigest(), hashlib.md5("other").hexdigest()
+        self.assertEqual([same, other], uploaded)
+        self.assertEqual(sorted([same, other]), sorted(self.bucket.objects))  # the uploads are all deleted
+        self.assertEqual(same, p2.file_name)
+        self.assertEqual("ready", p2.media_state)
+        self.assertEqual({same: 3, other: 1}, dict(db.session.query(Media.key_name, Media.ref_count)))
+
+        PendingDeletion.queue([hashlib.md5("deleted").hexdigest()])  # a deleted image uploaded again is kept
+        p3 = Post.create(author_id=1, description="test", file_name=image("deleted"), tag_list=None,
+                         choice_data=[("text_choice1", None), ("text_choice2", None)])
+        self.assertEqual(0, PendingDeletion.query.count())
+
+        self.app.secret_key = 'test'  # deleting a post flashes a message
+        with self.app.test_request_context():
+            Post.delete_by_post_id(p1.post_id)
+        # the image only p1 had is deleted, the one p2 still has is kept
+        self.assertEqual({same: 1, hashlib.md5("deleted").hexdigest(): 1},
+                         dict(db.session.query(Media.key_name, Media.ref_count)))
+        with self.app.test_request_context():
+            Post.delete_by_post_id(p2.post_id)
+            Post.delete_by_post_id(p3.post_id)
+        self.assertEqual(0, Media.query.count())
+
+    def test_content_md5(self):
+        """test the etag is taken as the md5 of an upload only when it is one"""
+        key_name = self.upload(1, "data")
+        self.assertEqual(hashlib.md5("data").hexdigest(), content_md5(self.bucket.get_key(key_name)))
+
+        class MultipartKey(MemoryKey):
+            etag = '"%s-2"' % hashlib.md5("parts").hexdigest()
+        self.assertEqual(hashlib.md5("data").hexdigest(), content_md5(MultipartKey(self.bucket, key_name)))
+
+        class EncryptedKey(MemoryKey):
+            etag = '"%s"' % hashlib.md5("ciphertext").hexdigest()
+            encrypted = 'aws:kms'
+        self.assertEqual(hashlib.md5("data").hexdigest(), content_md5(EncryptedKey(self.bucket, key_name)))
+
+    def test_verify_upload(self):
+        """test a post only takes files its author uploaded, of a type allowed and not too large"""
+        form = sign_upload(1, "photo.JPG")
+        self.assertTrue(form['key'].startswith(upload_key_prefix(1)))
+        self.assertNotEqual(form['key'], sign_upload(1, "photo.JPG")['key'])
+        self.assertRaises(InvalidUpload, sign_upload, 1, "page.html")
+
+        self.assertEqual(4, verify_upload(1, self.upload(1, "data")).size)
+        self.assertRaises(InvalidUpload, verify_upload, 2, self.upload(1))  # someone else's
+        self.assertRaises(InvalidUpload, verify_upload, 1, upload_key_prefix(1) + "missing")
+        self.assertRaises(InvalidUpload, verify_upload, 1, self.upload(1, content_type="text/html"))
+        max_upload_size, app.models.MAX_UPLOAD_SIZE = app.models.MAX_UPLOAD_SIZE, 3
+        try:
+            self.assertRaises(UploadTooLarge, verify_upload, 1, self.upload(1, "data"))
+        finally:
+            app.models.MAX_UPLOAD_SIZE = max_upload_size
+
+        self.assertRaises(InvalidUpload, Post.create, author_id=1, description="test", file_name=None,
+                          tag_list="food", choice_data=[("x", self.upload(1)), ("y", self.upload(2))])
+        self.assertEqual(0, Post.query.count())
+        self.assertEqual(0, Tag.query.count())
+
+    def test_unit_of_work(self):
+        """test the helpers called within a unit of work are committed together at its end, or not at all"""
+        commits, called = [], []
+        record = lambda conn: commits.append(conn)
+        event.listen(db.engine, 'commit', record)
+        try:
+            with UnitOfWork():
+                u1 = User.create(user_id=1, email="a", password="", user_name="a", gender="female", age_range=21,
+                                 profile_pic="")
+                with UnitOfWork():  # joins the outer one
+                    u2 = User.create(user_id=2, email="b", password="", user_name="b", gender="male",
+                                     age_range=21, profile_pic="", friend_ids=[1])
+                    u2.update_user_info(location="Shenzhen, China")
+                p = Post.create(author_id=1, description="post", file_name=None, tag_list="food",
+                                choice_data=[("x", None), ("y", None)])
+                Comment.create(content="hi", user_id=2, post_id=p.post_id)
+                UnitOfWork.after_commit(lambda: called.append(len(commits)))
+                self.assertEqual([], commits)
+                self.assertEqual([], called)
+        finally:
+            event.remove(db.engine, 'commit', record)
+        self.assertEqual(1, len(commits))
+        self.assertEqual([1], called)  # run once committed
+        self.assertTrue(u2.is_following(u1))
+
+        @UnitOfWork()
+        def failing_request():
+            Comment.create(content="lost", user_id=2, post_id=p.post_id)
+            UnitOfWork.after_commit(lambda: called.append("rolled back"))
+            raise ValueError("the request failed")
+
+        self.assertRaises(ValueError, failing_request)
+        self.assertEqual(["hi"], [comment.content for comment in Comment.query])
+        self.assertEqual([1], called)
+        self.assertFalse(UnitOfWork.active())
+        UnitOfWork.after_commit(lambda: called.append("now"))  # outside a unit of work, at once
+        self.assertEqual([1, "now"], called)
+
+    def test_comments_page(self):
+        """test the comments are paged newest first with their authors, and counted on the post"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        comment_ids = [Comment.create(content="comment %d" % number, user_id=(u1, u2)[number % 2].user_id,
+                                      post_id=p.post_id).comment_id for number in range(5)]
+        db.session.expire_all()
+        self.assertEqual(5, Post.get_post_by_id(p.post_id).comment_count)
+
+        statements = []
+        record = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            page = Comment.get_comments_page(p.post_id, per_page=2)
+            names = [comment.user.user_name for comment in page.items]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(1, len(statements))  # the authors come with the comments
+        self.assertEqual(["lgdfv", "lgdfv"], names)
+        self.assertEqual(comment_ids[:2:-1], [comment.comment_id for comment in page.items])
+        self.assertFalse(page.has_prev)
+
+        page = Comment.get_comments_page(p.post_id, page.next_cursor, per_page=2)
+        self.assertEqual(comment_ids[2:0:-1], [comment.comment_id for comment in page.items])
+        page = Comment.get_comments_page(p.post_id, page.next_cursor, per_page=2)
+        self.assertEqual(comment_ids[:1], [comment.comment_id for comment in page.items])
+        self.assertFalse(page.has_next)
+
+        self.app.secret_key = 'test'  # deleting a comment flashes a message
+        with self.app.test_request_context():
+            Comment.delete_by_comment_id(comment_ids[0])
+        db.session.expire_all()
+        self.assertEqual(4, Post.get_post_by_id(p.post_id).comment_count)
+        Post.query.update({Post.comment_count: 0})
+        self.assertEqual(1, Post.reconcile_comment_counts())
+        self.assertEqual(4, Post.get_post_by_id(p.post_id).comment_count)
+
+    def test_search(self):
+        """test the posts are searched by every word, ranked by where the words are, and kept up to date"""
+        u1, u2 = self.test_create_users()
+        cake = Post.create(author_id=u1.user_id, description="Which cake should I bake?", file_name=None,
+                           tag_list="dessert,baking", choice_data=[("Chocolate cake", None), ("Lemon tart", None)])
+        trip = Post.create(author_id=u2.user_id, description="Where to go this summer?", file_name=None,
+                           tag_list="travel", choice_data=[("Lisbon", None), ("Rome", None)])
+        self.assertEqual([cake.post_id], [post.post_id for post in Post.search("CAKE").items])
+        self.assertEqual([cake.post_id], [post.post_id for post in Post.search("chocolate dessert").items])
+        self.assertEqual([], Post.search("chocolate rome").items)  # every word has to match
+        self.assertEqual([], Post.search("the").items)
+
+        comment = Comment.create(content="a Lisbon custard tart is even better than cake", user_id=u1.user_id,
+                                 post_id=trip.post_id)
+        results = Post.search("cake")
+        self.assertEqual(2, results.total)
+        self.assertEqual([cake.post_id, trip.post_id], [post.post_id for post in results.items])  # question first
+        self.assertEqual([trip.post_id], [post.post_id for post in Post.search("lisbon custard").items])
+        page = Post.search("cake", page=2, per_page=1)
+        self.assertEqual([trip.post_id], [post.post_id for post in page.items])
+        self.assertEqual(2, page.pages)
+
+        self.app.secret_key = 'test'  # deleting flashes a message
+        with self.app.test_request_context():
+            Comment.delete_by_comment_id(comment.comment_id)
+            self.assertEqual([], Post.search("custard").items)
+            self.assertEqual([trip.post_id], [post.post_id for post in Post.search("lisbon").items])
+            Post.delete_by_post_id(cake.post_id)
+        self.assertEqual([], Post.search("cake").items)
+        self.assertEqual(0, SearchTerm.query.filter_by(post_id=cake.post_id).count())
+
+        SearchTerm.query.delete()
+        self.assertEqual(1, Post.rebuild_search_index())
+        self.assertEqual([trip.post_id], [post.post_id for post in Post.search("travel summer").items])
+
+    def test_live_results(self):
+        """test the results are pushed once per version to every subscriber, at most rate times a second"""
+        u1, u2 = self.test_create_users()
+        p = self.test_create_post()
+        c1, c2 = [choice.choice_id for choice in Choice.get_choices_by_post_id(p.post_id)]
+        rendered = []
+
+        def render(post_id):
+            rendered.append(post_id)
+            return Post.render_live_results(post_id)
+        hub = ResultsHub(Post.get_versions, render, rate=2)
+        hub._thread = True  # no polling thread, the test polls by hand
+
+        current = hub.subscribe(p.post_id, p.version)
+        stale = hub.subscribe(p.post_id)
+        self.assertEqual([p.post_id], hub.poll(now=100))
+        self.assertIsNone(current.next(0))  # it already shows this version
+        version, data = stale.next(0)
+        self.assertEqual(p.version, version)
+        self.assertEqual(0, json.loads(data)[2])
+
+        Vote.create(user_id=u1.user_id, choice_id=c1)
+        Vote.create(user_id=u2.user_id, choice_id=c2)
+        self.assertEqual([], hub.poll(now=100.2))  # too soon, the votes are coalesced into the next update
+        self.assertEqual([p.post_id], hub.poll(now=100.6))
+        self.assertEqual([], hub.poll(now=200))  # nothing changed
+        self.assertEqual([p.post_id] * 2, rendered)
+        for subscription in (current, stale):
+            version, data = subscription.next(0)
+            self.assertEqual(p.version, version)
+            vote_dict, total_votes_percent, total_votes = json.loads(data)[:3]
+            self.assertEqual({str(c1): 1, str(c2): 1}, vote_dict)
+            self.assertEqual(2, total_votes)
+
+        late = hub.subscribe(p.post_id)  # gets the latest results without waiting for a change
+        self.assertEqual(p.version, late.next(0)[0])
+
+        stream = event_stream(hub, current, heartbeat=0)
+        self.assertEqual("retry: 3000\n\n", next(stream))
+        self.assertEqual(": heartbeat\n\n", next(stream))
+        stream.close()
+        self.assertEqual(2, hub.subscribers(p.post_id))
+        hub.unsubscribe(stale)
+        hub.unsubscribe(late)
+        self.assertEqual(0, hub.subscribers(p.post_id))
+        self.assertEqual([], hub.poll(now=300))
+
 
 
 if __name__ == "__main__":